@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""
+Batch processing of messages queued by ``spoolclient.py``.
+
+Messages are claimed by batches. Auto-reply messages of all recipients
+are fetched with a single query and, when the throttle backend
+supports it, throttled senders are found with another one, so most
+messages are rejected without writing anything.
+"""
+
+import io
+import logging
+import time
+
+from django import db
+from django.core import mail
+
+from . import lib, metrics, outbox, spool, throttle
+from .pipeline import Pipeline
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ATTEMPTS = outbox.DEFAULT_MAX_ATTEMPTS
+DEFAULT_BACKOFF = outbox.DEFAULT_BACKOFF
+
+
+def read_entry(entry):
+    """Return the (sender, recipients, message headers) of an entry."""
+    envelope, headers = spool.unpack(entry.read())
+    original_msg = lib.read_message_headers(io.BytesIO(headers + b"\n"))
+    return envelope["sender"], envelope["recipients"], original_msg
+
+
+def process_batch(queue, entries, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                  backoff=DEFAULT_BACKOFF):
+    """Process claimed entries.
+
+    Failed entries are retried later: replies already sent are not sent
+    twice since they are throttled.
+
+    :return: a (processed, deferred, failed) tuple
+    """
+    processed = deferred = failed = 0
+    messages = []
+    for entry in entries:
+        try:
+            messages.append((entry, read_entry(entry)))
+        except (ValueError, KeyError) as exc:
+            logger.error("invalid spool entry %s: %s", entry.name, exc)
+            queue.fail(entry)
+            failed += 1
+
+    def defer(entry):
+        if entry.attempts + 1 >= max_attempts:
+            logger.error(
+                "giving up spool entry %s after %d attempts", entry.name,
+                entry.attempts + 1)
+            queue.fail(entry)
+            return False
+        queue.retry(
+            entry, outbox.get_retry_delay(entry.attempts, backoff))
+        return True
+
+    try:
+        recipients = {
+            rcpt for entry, (sender, rcpts, msg) in messages for rcpt in rcpts
+        }
+        armessages = lib.get_armessages(sorted(recipients))
+        timeout = lib.get_autoreplies_timeout() if armessages else None
+        throttled = set()
+        if armessages:
+            pairs = {
+                (armessages[rcpt].pk, sender)
+                for entry, (sender, rcpts, msg) in messages
+                for rcpt in rcpts if rcpt in armessages
+            }
+            throttled = throttle.get_backend().prefetch(
+                list(pairs), timeout)
+    except db.Error:
+        logger.exception("Failed to prefetch autoreply messages")
+        for entry, message in messages:
+            if defer(entry):
+                deferred += 1
+            else:
+                failed += 1
+        return processed, deferred, failed
+
+    connection = mail.get_connection()
+    try:
+        for entry, (sender, rcpts, original_msg) in messages:
+            pipeline = Pipeline(
+                sender, rcpts, lambda: original_msg, timeout=timeout,
+                armessages=armessages, throttled=throttled)
+            try:
+                candidates = pipeline.decide()
+                failures = {}
+                if candidates:
+                    failures = pipeline.send(candidates, connection)
+            except db.Error:
+                logger.exception("Failed to process spool entry")
+                failures = True
+            if failures:
+                if defer(entry):
+                    deferred += 1
+                else:
+                    failed += 1
+                continue
+            queue.complete(entry)
+            processed += 1
+    finally:
+        connection.close()
+    return processed, deferred, failed
+
+
+def run(queue, batch_size=100, loop=False, max_wait=60, **options):
+    """Process the spool, forever if loop is True.
+
+    :return: the number of processed entries
+    """
+    total = 0
+    watcher = spool.Watcher(queue) if loop else None
+    try:
+        while True:
+            entries = queue.claim(batch_size)
+            if entries:
+                processed, deferred, failed = process_batch(
+                    queue, entries, **options)
+                total += processed
+                logger.info(
+                    "batch of %d message(s): %d processed, %d deferred, "
+                    "%d failed", len(entries), processed, deferred, failed)
+                metrics.flush()
+                db.close_old_connections()
+                continue
+            if not loop:
+                return total
+            timeout = max_wait
+            next_date = queue.next_date()
+            if next_date is not None:
+                timeout = max(0, min(timeout, next_date - time.time()))
+            watcher.wait(timeout)
+    finally:
+        if watcher is not None:
+            watcher.close()
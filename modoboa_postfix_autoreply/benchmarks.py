@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the autoreply command.
+
+They are not part of the regular test suite, run them explicitly::
+
+  $ python manage.py test modoboa_postfix_autoreply.benchmarks
+
+Results are compared to the baselines stored in the file defined by
+the ``AUTOREPLY_BENCHMARK_BASELINES`` environment variable
+(:file:`benchmarks.json` next to this file by default). Scenarios
+without baseline fail. Set the ``AUTOREPLY_BENCHMARK_UPDATE``
+environment variable to record new baselines, and
+``AUTOREPLY_BENCHMARK_TOLERANCE`` to change the allowed slowdown factor
+(2 by default). Timings depend on the machine: record baselines and
+compare on the same one (the CI records them on the base branch of
+pull requests first).
+"""
+
+import base64
+import email.header
+import functools
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from io import BytesIO, TextIOWrapper
+
+from django.core import mail, management
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+
+from modoboa.admin import factories as admin_factories
+from modoboa.lib.tests import ModoTestCase
+from . import factories, replies
+
+BASELINES_PATH = os.environ.get(
+    "AUTOREPLY_BENCHMARK_BASELINES",
+    os.path.join(os.path.dirname(__file__), "benchmarks.json"))
+
+ITERATIONS = int(os.environ.get("AUTOREPLY_BENCHMARK_ITERATIONS", 200))
+TOLERANCE = float(os.environ.get("AUTOREPLY_BENCHMARK_TOLERANCE", 2))
+MEMORY_TOLERANCE = 1.2
+
+RECIPIENTS_COUNT = 10
+
+HEADERS = """From: Homer Simpson <{sender}>
+To: {recipients}
+Date: Wed, 15 Mar 2017 18:35:19 +0100
+Message-ID: <{iteration}.benchmark@simpson.test>
+Subject: {subject}
+"""
+
+
+def small_message(sender, recipients, iteration):
+    """A short plain text message."""
+    return HEADERS.format(
+        sender=sender, recipients=", ".join(recipients),
+        iteration=iteration, subject="Small message"
+    ) + "Content-Type: text/plain; charset=UTF-8\n\nHello!\n"
+
+
+@functools.lru_cache(maxsize=None)
+def get_attachment():
+    """Return 1MB of random data (base64 encoded)."""
+    return base64.encodebytes(os.urandom(1024 * 1024)).decode("ascii")
+
+
+def huge_message(sender, recipients, iteration):
+    """A multipart message with 5MB of attachments."""
+    parts = [
+        HEADERS.format(
+            sender=sender, recipients=", ".join(recipients),
+            iteration=iteration, subject="Huge message"),
+        "Content-Type: multipart/mixed; boundary=BOUNDARY\n\n",
+        "--BOUNDARY\nContent-Type: text/plain; charset=UTF-8\n\nHello!\n",
+    ]
+    for index in range(5):
+        parts.append(
+            "--BOUNDARY\nContent-Type: application/octet-stream\n"
+            "Content-Transfer-Encoding: base64\n"
+            "Content-Disposition: attachment; filename=\"{}.bin\"\n\n"
+            "{}".format(index, get_attachment()))
+    parts.append("--BOUNDARY--\n")
+    return "".join(parts)
+
+
+def encoded_subject_message(sender, recipients, iteration):
+    """A message with a long RFC 2047 encoded subject."""
+    subject = email.header.Header(
+        "Réunion à propos des congés d'été " * 4, "utf-8").encode()
+    return HEADERS.format(
+        sender=sender, recipients=", ".join(recipients),
+        iteration=iteration, subject=subject
+    ) + "Content-Type: text/plain; charset=UTF-8\n\nHello!\n"
+
+
+@override_settings(
+    EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+class BenchmarkTestCase(ModoTestCase):
+    """Measure the autoreply command on synthetic messages."""
+
+    results = {}
+
+    @classmethod
+    def setUpTestData(cls):  # NOQA:N802
+        """Create some data."""
+        super(BenchmarkTestCase, cls).setUpTestData()
+        admin_factories.populate_database()
+        domain = admin_factories.DomainFactory(name="bench.test")
+        cls.recipients = []
+        for index in range(RECIPIENTS_COUNT):
+            mbox = admin_factories.MailboxFactory(
+                address="user{}".format(index), domain=domain,
+                user__username="user{}@bench.test".format(index),
+                user__groups=("SimpleUsers", ))
+            factories.ARmessageFactory(mbox=mbox)
+            cls.recipients.append(mbox.full_address)
+
+    @classmethod
+    def tearDownClass(cls):  # NOQA:N802
+        super(BenchmarkTestCase, cls).tearDownClass()
+        if os.environ.get("AUTOREPLY_BENCHMARK_UPDATE") and cls.results:
+            baselines = cls.load_baselines()
+            baselines.update(cls.results)
+            with open(BASELINES_PATH, "w") as fp:
+                json.dump(baselines, fp, indent=2, sort_keys=True)
+                fp.write("\n")
+
+    @staticmethod
+    def load_baselines():
+        if not os.path.exists(BASELINES_PATH):
+            return {}
+        with open(BASELINES_PATH) as fp:
+            return json.load(fp)
+
+    def setUp(self):
+        super(BenchmarkTestCase, self).setUp()
+        self.stdin = sys.stdin
+        replies.templates.clear()
+
+    def tearDown(self):
+        sys.stdin = self.stdin
+
+    @staticmethod
+    def make_stdin(content):
+        """Like Postfix: a binary stream (headers only are read)."""
+        return TextIOWrapper(BytesIO(content.encode("utf-8")))
+
+    def call_command(self, stdin, sender, recipients):
+        sys.stdin = stdin
+        management.call_command("autoreply", sender, *recipients)
+
+    def run_scenario(self, name, build_message, recipients):
+        """Run a scenario, then compare results to the baseline."""
+        latencies = []
+        queries = []
+        for index in range(ITERATIONS + 1):
+            # A new sender for each iteration, so throttling never applies
+            sender = "sender{}@{}.test".format(index, name)
+            content = build_message(sender, recipients, index)
+            mail.outbox = []
+            if index == ITERATIONS:
+                break
+            stdin = self.make_stdin(content)
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                self.call_command(stdin, sender, recipients)
+                latencies.append(time.perf_counter() - start)
+            queries.append(len(context.captured_queries))
+            self.assertEqual(len(mail.outbox), len(recipients))
+        # Memory is measured apart, tracemalloc slows everything down
+        stdin = self.make_stdin(content)
+        tracemalloc.start()
+        try:
+            self.call_command(stdin, sender, recipients)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        latencies.sort()
+        result = {
+            "throughput": len(latencies) / sum(latencies),
+            "p50": statistics.median(latencies),
+            "p99": latencies[min(len(latencies) - 1,
+                                 int(len(latencies) * 0.99))],
+            "queries": max(queries),
+            "peak_memory": peak,
+        }
+        self.results[name] = result
+        sys.stderr.write(
+            "\n{}: {:.1f} msg/s, p50={:.2f}ms, p99={:.2f}ms, {} queries, "
+            "peak memory={:.1f}KiB\n".format(
+                name, result["throughput"], result["p50"] * 1000,
+                result["p99"] * 1000, result["queries"],
+                result["peak_memory"] / 1024))
+        self.check_baseline(name, result)
+
+    def check_baseline(self, name, result):
+        if os.environ.get("AUTOREPLY_BENCHMARK_UPDATE"):
+            return
+        baseline = self.load_baselines().get(name)
+        if baseline is None:
+            self.fail(
+                "{}: no baseline found in {}, record one with "
+                "AUTOREPLY_BENCHMARK_UPDATE=1".format(name, BASELINES_PATH))
+        self.assertLessEqual(
+            result["queries"], baseline["queries"], "{}: queries".format(name))
+        for key in ["p50", "p99"]:
+            self.assertLessEqual(
+                result[key], baseline[key] * TOLERANCE,
+                "{}: {} latency".format(name, key))
+        self.assertGreaterEqual(
+            result["throughput"], baseline["throughput"] / TOLERANCE,
+            "{}: throughput".format(name))
+        self.assertLessEqual(
+            result["peak_memory"], baseline["peak_memory"] * MEMORY_TOLERANCE,
+            "{}: peak memory".format(name))
+
+    def test_small_message(self):
+        self.run_scenario("small", small_message, self.recipients[:1])
+
+    def test_huge_message(self):
+        self.run_scenario("huge", huge_message, self.recipients[:1])
+
+    def test_encoded_subject(self):
+        self.run_scenario(
+            "encoded_subject", encoded_subject_message, self.recipients[:1])
+
+    def test_multiple_recipients(self):
+        self.run_scenario(
+            "multiple_recipients", small_message, self.recipients)
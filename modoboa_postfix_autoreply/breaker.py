@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+Load shedding helpers for the autoreply command.
+
+Each message delivered through pipe(8) starts a new process, so the
+state of the circuit breaker is kept in a small file shared by all of
+them (protected by an exclusive lock). When too many invocations
+failed recently, the circuit opens: new invocations are deferred
+immediately, without touching the database or the SMTP server, until
+the cooldown period is over. Then a single invocation is allowed to
+probe the backends and closes the circuit if it succeeds.
+"""
+
+import contextlib
+import fcntl
+import json
+import logging
+import signal
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THRESHOLD = 5
+DEFAULT_WINDOW = 60
+DEFAULT_COOLDOWN = 30
+
+
+class DeadlineExceeded(BaseException):
+    """Raised when an invocation takes too long.
+
+    Not an ``Exception`` so handlers dealing with a single reply don't
+    catch it: the whole invocation must be deferred.
+    """
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """Raise DeadlineExceeded if the enclosed code lasts too long.
+
+    Uses SIGALRM, so it only works in the main thread. Blocking calls
+    are interrupted as soon as they return to the interpreter: also
+    configure connection and statement timeouts of your database and
+    ``EMAIL_TIMEOUT``.
+    """
+    if not seconds or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def handler(signum, frame):
+        raise DeadlineExceeded(
+            "deadline of {}s exceeded".format(seconds))
+
+    previous = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+class CircuitBreaker(object):
+    """A circuit breaker shared by processes.
+
+    :param str path: state file
+    :param int threshold: number of failures opening the circuit
+    :param int window: failures older than this (seconds) are forgotten
+    :param int cooldown: time (seconds) during which the circuit stays open
+    """
+
+    def __init__(self, path, threshold=DEFAULT_THRESHOLD,
+                 window=DEFAULT_WINDOW, cooldown=DEFAULT_COOLDOWN):
+        self.path = path
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+
+    @contextlib.contextmanager
+    def state(self):
+        """Lock and load the state, save it when done."""
+        with open(self.path, "a+") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            fp.seek(0)
+            content = fp.read()
+            try:
+                state = json.loads(content) if content else {}
+            except ValueError:
+                logger.warning("corrupted circuit breaker state, resetting")
+                state = {}
+            state.setdefault("failures", [])
+            state.setdefault("opened_at", None)
+            yield state
+            fp.seek(0)
+            fp.truncate()
+            json.dump(state, fp)
+
+    def allow(self, now=None):
+        """Tell if an invocation can proceed."""
+        if now is None:
+            now = time.time()
+        with self.state() as state:
+            if state["opened_at"] is None:
+                return True
+            if now - state["opened_at"] < self.cooldown:
+                return False
+            # Half open: let this invocation probe, keep others out
+            state["opened_at"] = now
+            return True
+
+    def record_success(self):
+        with self.state() as state:
+            if state["opened_at"] is not None:
+                logger.info("circuit breaker closed")
+            state["failures"] = []
+            state["opened_at"] = None
+
+    def record_failure(self, now=None):
+        if now is None:
+            now = time.time()
+        with self.state() as state:
+            failures = [
+                date for date in state["failures"]
+                if now - date < self.window
+            ]
+            failures.append(now)
+            state["failures"] = failures[-self.threshold:]
+            if len(failures) >= self.threshold or state["opened_at"]:
+                if state["opened_at"] is None:
+                    logger.warning(
+                        "circuit breaker opened after %d failures",
+                        len(failures))
+                state["opened_at"] = now
+
+
+def get_breaker():
+    """Return the configured circuit breaker or None."""
+    config = getattr(settings, "AUTOREPLY_CIRCUIT_BREAKER", {})
+    if not config.get("PATH"):
+        return None
+    return CircuitBreaker(
+        config["PATH"],
+        threshold=config.get("THRESHOLD", DEFAULT_THRESHOLD),
+        window=config.get("WINDOW", DEFAULT_WINDOW),
+        cooldown=config.get("COOLDOWN", DEFAULT_COOLDOWN))
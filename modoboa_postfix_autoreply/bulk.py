@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+"""Batch autoreply side effects of bulk operations.
+
+Creating, renaming or deleting domains and mailboxes triggers signal
+handlers which update transport entries and routing aliases, using a
+few queries per object. During a bulk operation (an import for
+example), handlers only record what changed and everything is applied
+at the end with a few set-based statements::
+
+  from modoboa_postfix_autoreply.bulk import bulk_operation
+
+  with bulk_operation():
+      for row in rows:
+          import_mailbox(row)
+
+Operations are tracked per thread. Nested contexts are merged into the
+outermost one. The block runs in a transaction: objects and their
+autoreply side effects are committed, or rolled back if an exception
+is raised, together.
+"""
+
+import contextlib
+import logging
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, Value, When
+
+from modoboa.admin import models as admin_models
+from modoboa.transport import models as tr_models
+
+from . import routing
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 500
+
+_local = threading.local()
+
+
+def get_current():
+    """Return the bulk operation in progress in this thread, or None."""
+    return getattr(_local, "operation", None)
+
+
+def chunks(items, size=CHUNK_SIZE):
+    items = list(items)
+    for pos in range(0, len(items), size):
+        yield items[pos:pos + size]
+
+
+def get_transport_pattern(name):
+    return "autoreply.{}".format(name)
+
+
+class BulkOperation(object):
+    """Changes recorded during a bulk operation."""
+
+    def __init__(self):
+        self.created_domains = set()
+        self.deleted_domains = set()
+        # domain id -> name before the operation
+        self.renamed_domains = {}
+        # address before the operation -> current address
+        self.renamed_mailboxes = {}
+        self.deleted_mailboxes = set()
+
+    def domain_created(self, domain):
+        self.deleted_domains.discard(domain.name)
+        self.created_domains.add(domain.name)
+
+    def domain_renamed(self, domain, oldname):
+        if oldname in self.created_domains:
+            self.created_domains.discard(oldname)
+            self.created_domains.add(domain.name)
+            return
+        self.renamed_domains.setdefault(domain.pk, oldname)
+
+    def domain_deleted(self, domain):
+        name = self.renamed_domains.pop(domain.pk, domain.name)
+        if name in self.created_domains:
+            self.created_domains.discard(name)
+            return
+        self.deleted_domains.add(name)
+
+    def mailbox_renamed(self, old_address, mbox):
+        for original, current in self.renamed_mailboxes.items():
+            if current == old_address:
+                old_address = original
+                break
+        self.renamed_mailboxes[old_address] = mbox.full_address
+
+    def mailbox_deleted(self, mbox):
+        address = mbox.full_address
+        for original, current in list(self.renamed_mailboxes.items()):
+            if current == address:
+                del self.renamed_mailboxes[original]
+                self.deleted_mailboxes.add(original)
+        self.deleted_mailboxes.add(address)
+
+    def apply_domains(self):
+        chunk_size = getattr(settings, "AUTOREPLY_RENAME_CHUNK_SIZE", 1000)
+        for domain in admin_models.Domain.objects.filter(
+                pk__in=self.renamed_domains):
+            oldname = self.renamed_domains[domain.pk]
+            if oldname == domain.name:
+                continue
+            tr_models.Transport.objects.filter(
+                pattern=get_transport_pattern(oldname)).update(
+                    pattern=get_transport_pattern(domain.name))
+            routing.rename_domain(domain, oldname, chunk_size)
+        for names in chunks(self.deleted_domains):
+            tr_models.Transport.objects.filter(pattern__in=[
+                get_transport_pattern(name) for name in names
+            ]).delete()
+        for names in chunks(self.created_domains):
+            patterns = {get_transport_pattern(name) for name in names}
+            existing = set(tr_models.Transport.objects.filter(
+                pattern__in=patterns).values_list("pattern", flat=True))
+            tr_models.Transport.objects.bulk_create([
+                tr_models.Transport(pattern=pattern, service="autoreply")
+                for pattern in sorted(patterns - existing)
+            ])
+
+    def apply_mailboxes(self):
+        renamed = [
+            (old, new) for old, new in self.renamed_mailboxes.items()
+            if old != new
+        ]
+        for items in chunks(renamed):
+            olds = [old for old, new in items]
+            routing.get_routing_recipients(
+                olds + [new for old, new in items]
+            ).filter(
+                address__in=[routing.get_routing_address_of(old)
+                             for old in olds]
+            ).update(address=Case(*[
+                When(address=routing.get_routing_address_of(old),
+                     then=Value(routing.get_routing_address_of(new)))
+                for old, new in items
+            ], default=F("address")))
+        for addresses in chunks(self.deleted_mailboxes):
+            routing.get_routing_recipients(addresses).delete()
+
+    def apply(self):
+        """Apply recorded changes."""
+        with transaction.atomic():
+            self.apply_domains()
+            self.apply_mailboxes()
+        logger.debug(
+            "bulk operation: %d domain(s) created, %d renamed, %d deleted, "
+            "%d mailbox(es) renamed, %d deleted", len(self.created_domains),
+            len(self.renamed_domains), len(self.deleted_domains),
+            len(self.renamed_mailboxes), len(self.deleted_mailboxes))
+
+
+@contextlib.contextmanager
+def bulk_operation():
+    """Defer autoreply signal handlers until the end of the block."""
+    operation = get_current()
+    if operation is not None:
+        # Nested: the outermost context applies changes
+        yield operation
+        return
+    operation = _local.operation = BulkOperation()
+    try:
+        with transaction.atomic():
+            yield operation
+            _local.operation = None
+            operation.apply()
+    finally:
+        _local.operation = None
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+"""
+Detection of mailing lists, bulk and automatically generated messages.
+
+Rules can be customized with the ``AUTOREPLY_BULK_RULES`` setting,
+missing keys keep their default value. Sender rules replace the
+default lists, header rules are merged with the default ones::
+
+  AUTOREPLY_BULK_RULES = {
+      "SENDER_LOCALPARTS": ["mailer-daemon", "listserv", "majordomo"],
+      "SENDER_PREFIXES": ["owner-"],
+      "SENDER_SUFFIXES": ["-request"],
+      "HEADERS": {
+          "X-Campaign": None,
+          "Precedence": r"^(bulk|junk)$",
+          "X-Mailer": False,
+      }
+  }
+
+A header rule with a ``None`` value matches if the header is present,
+otherwise the (case insensitive) regular expression must match the
+header value. ``False`` removes a default rule. Rules are compiled
+once per process.
+"""
+
+import functools
+import re
+
+from django.conf import settings
+
+from modoboa.lib.email_utils import split_mailbox
+
+DEFAULT_RULES = {
+    "SENDER_LOCALPARTS": ["mailer-daemon", "listserv", "majordomo"],
+    "SENDER_PREFIXES": ["owner-"],
+    "SENDER_SUFFIXES": ["-request"],
+    "HEADERS": {
+        # Mailing list filter based on
+        # https://tools.ietf.org/html/rfc5230#page-7
+        "List-Id": None,
+        "List-Help": None,
+        "List-Subscribe": None,
+        "List-Unsubscribe": None,
+        "List-Post": None,
+        "List-Owner": None,
+        "List-Archive": None,
+        "Precedence": r"^(bulk|list|junk)$",
+        # https://tools.ietf.org/html/rfc3834#section-5
+        "Auto-Submitted": r"^(?!no\b)",
+        # Microsoft Exchange
+        "X-Auto-Response-Suppress": r"\b(all|oof|autoreply)\b",
+        "X-Mailer": r"^PHPMailer$",
+        # Spam filters (SpamAssassin, rspamd)
+        "X-Spam-Flag": r"^yes\b",
+        "X-Spam-Status": r"^yes\b",
+        "X-Spam": r"^yes\b",
+    }
+}
+
+
+class BulkClassifier(object):
+    """Compiled set of rules."""
+
+    def __init__(self, rules):
+        self.localparts = frozenset(
+            value.lower() for value in rules["SENDER_LOCALPARTS"])
+        self.prefixes = tuple(
+            value.lower() for value in rules["SENDER_PREFIXES"])
+        self.suffixes = tuple(
+            value.lower() for value in rules["SENDER_SUFFIXES"])
+        self.headers = {
+            name.lower(): (
+                re.compile(pattern, re.IGNORECASE)
+                if pattern is not None else None
+            )
+            for name, pattern in rules["HEADERS"].items()
+            if pattern is not False
+        }
+
+    def match_sender(self, sender):
+        """Return the rule matching sender or None."""
+        localpart = split_mailbox(sender.lower())[0]
+        if localpart in self.localparts:
+            return localpart
+        if self.prefixes and localpart.startswith(self.prefixes):
+            return "prefix"
+        if self.suffixes and localpart.endswith(self.suffixes):
+            return "suffix"
+        return None
+
+    def match_message(self, msg):
+        """Return the name of the first matching header or None.
+
+        Headers are only visited once.
+        """
+        for name, value in msg.items():
+            try:
+                pattern = self.headers[name.lower()]
+            except KeyError:
+                continue
+            if pattern is None or pattern.search(str(value).strip()):
+                return name
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def get_classifier():
+    """Return the classifier built from settings."""
+    custom = dict(getattr(settings, "AUTOREPLY_BULK_RULES", {}))
+    rules = dict(DEFAULT_RULES)
+    rules["HEADERS"] = dict(DEFAULT_RULES["HEADERS"])
+    rules["HEADERS"].update(custom.pop("HEADERS", {}))
+    rules.update(custom)
+    return BulkClassifier(rules)
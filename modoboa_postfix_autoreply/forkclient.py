@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Client of the autoreply fork server.
+
+This script is meant to be invoked by Postfix's pipe(8) instead of
+``manage.py autoreply``. It only uses the standard library so it
+starts quickly: its standard streams and arguments are handed over to
+a pre-initialised child of the fork server and it exits with the exit
+code of the ``autoreply`` command.
+
+Usage::
+
+  forkclient.py [--socket PATH] [--fallback MANAGE_PY] <autoreply args>
+
+If the fork server can't be reached, the ``autoreply`` command is
+executed through the ``--fallback`` manage.py script when provided,
+otherwise the delivery is deferred.
+"""
+
+import argparse
+import array
+import json
+import os
+import socket
+import sys
+
+DEFAULT_SOCKET = "/var/run/modoboa/autoreply-fork.sock"
+EX_TEMPFAIL = 75
+
+
+def parse_args(argv):
+    """Split client options from autoreply ones."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--socket", default=DEFAULT_SOCKET)
+    parser.add_argument("--fallback")
+    return parser.parse_known_args(argv)
+
+
+def fallback(options, args):
+    """Run the autoreply command the usual way."""
+    if not options.fallback:
+        sys.stderr.write("autoreply fork server unavailable\n")
+        return EX_TEMPFAIL
+    os.execv(
+        sys.executable,
+        [sys.executable, options.fallback, "autoreply"] + args)
+
+
+def main(argv=None):
+    options, args = parse_args(sys.argv[1:] if argv is None else argv)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(options.socket)
+    except OSError:
+        return fallback(options, args)
+    payload = json.dumps({"args": args}).encode("utf-8")
+    fds = array.array("i", [0, 1, 2])
+    try:
+        sock.sendmsg(
+            [payload],
+            [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds.tobytes())])
+    except OSError:
+        # Nothing was handed over, stdin is still unread
+        sock.close()
+        return fallback(options, args)
+    # Wait for the exit code of the command
+    response = b""
+    try:
+        while not response.endswith(b"\n"):
+            chunk = sock.recv(64)
+            if not chunk:
+                break
+            response += chunk
+    except OSError:
+        # The child may have read stdin already, let Postfix retry
+        sys.stderr.write("autoreply fork server connection lost\n")
+        return EX_TEMPFAIL
+    finally:
+        sock.close()
+    try:
+        return int(response.strip())
+    except ValueError:
+        sys.stderr.write("autoreply child died unexpectedly\n")
+        return EX_TEMPFAIL
+
+
+if __name__ == "__main__":
+    sys.exit(main())
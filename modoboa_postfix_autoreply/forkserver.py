@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pre-initialised fork server for the autoreply command.
+
+The supervisor process loads Django and the models once. For each
+connection received from :mod:`modoboa_postfix_autoreply.forkclient`,
+it forks a child which receives the client's standard streams and runs
+the ``autoreply`` command as if it had been started by Postfix.
+"""
+
+import array
+import errno
+import json
+import logging
+import os
+import signal
+import socket
+import stat
+import sys
+import traceback
+
+from django.core.management import call_command, get_commands
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Standard streams sent by the client
+FDS_COUNT = 3
+MAX_REQUEST_SIZE = 65536
+
+
+def receive_request(conn):
+    """Receive arguments and file descriptors sent by a client."""
+    fds = array.array("i")
+    data, ancdata, flags, addr = conn.recvmsg(
+        MAX_REQUEST_SIZE, socket.CMSG_LEN(FDS_COUNT * fds.itemsize))
+    for cmsg_level, cmsg_type, cmsg_data in ancdata:
+        if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+            fds.frombytes(
+                cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+    if len(fds) != FDS_COUNT:
+        raise ValueError("Unexpected number of file descriptors")
+    return json.loads(data.decode("utf-8"))["args"], list(fds)
+
+
+def run_command(args):
+    """Run the autoreply command, return its exit code."""
+    try:
+        call_command("autoreply", *args)
+    except SystemExit as exc:
+        if exc.code is None:
+            return 0
+        if isinstance(exc.code, int):
+            return exc.code
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def handle_connection(conn):
+    """Child side: setup standard streams and run the command."""
+    try:
+        args, fds = receive_request(conn)
+    except (OSError, ValueError) as exc:
+        logger.error("Invalid request received: %s", exc)
+        return 1
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    sys.stdin = open(0, "r", closefd=False)
+    sys.stdout = open(1, "w", buffering=1, closefd=False)
+    sys.stderr = open(2, "w", buffering=1, closefd=False)
+    code = run_command(args)
+    connections.close_all()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    try:
+        conn.sendall("{}\n".format(code).encode("utf-8"))
+    except OSError:
+        pass
+    return code
+
+
+class ForkServer(object):
+    """Accept connections and fork a warm child for each of them."""
+
+    def __init__(self, path, socket_mode=None, max_children=32):
+        self.path = path
+        self.max_children = max_children
+        self.children = set()
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        if socket_mode is not None:
+            os.chmod(path, socket_mode)
+        self.sock.listen(128)
+        self.sock.settimeout(1)
+
+    def warmup(self):
+        """Import everything a child will need."""
+        from modoboa.admin import models as admin_models  # NOQA:F401
+        from . import lib  # NOQA:F401
+        from .management.commands import autoreply  # NOQA:F401
+        from .models import ARhistoric, ARmessage  # NOQA:F401
+        from .modo_extension import PostfixAutoreply
+
+        get_commands()
+        PostfixAutoreply().load()
+        # Children must open their own database connections
+        connections.close_all()
+
+    def reap_children(self, block=False):
+        """Collect terminated children."""
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if pid == 0:
+                return
+            self.children.discard(pid)
+            if block:
+                return
+
+    def fork(self, conn):
+        """Fork a child to handle conn."""
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            conn.close()
+            return
+        code = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self.sock.close()
+            code = handle_connection(conn)
+        finally:
+            os._exit(code)
+
+    def serve_forever(self):
+        """Main loop."""
+        while True:
+            self.reap_children()
+            while len(self.children) >= self.max_children:
+                self.reap_children(block=True)
+            try:
+                conn, addr = self.sock.accept()
+            except socket.timeout:
+                continue
+            except OSError as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                raise
+            conn.settimeout(None)
+            try:
+                self.fork(conn)
+            except OSError as exc:
+                logger.error("Failed to fork: %s", exc)
+                conn.close()
+
+    def close(self):
+        """Close the listening socket."""
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -4,22 +4,30 @@
 
 from __future__ import unicode_literals
 
-from django.urls import re_path
+from django.conf import settings
+from django.db import transaction
 from django.db.models import signals
+from django.urls import re_path
 from django.dispatch import receiver
 from django.utils.translation import gettext as _
 
+import django_rq
+
 from modoboa.admin import models as admin_models, signals as admin_signals
-from modoboa.core import signals as core_signals
+from modoboa.core import models as core_models, signals as core_signals
 from modoboa.transport import models as tr_models
 
-from . import forms, models
+from . import bulk, forms, jobs, models, replies, routing
 
 
 @receiver(signals.post_save, sender=admin_models.Domain)
 def manage_transport_entry(sender, instance, **kwargs):
     """Create or update a transport entry for this domain."""
+    operation = bulk.get_current()
     if kwargs.get("created"):
+        if operation is not None:
+            operation.domain_created(instance)
+            return
         tr_models.Transport.objects.get_or_create(
             pattern="autoreply.{}".format(instance), service="autoreply"
         )
@@ -27,24 +35,30 @@ def manage_transport_entry(sender, instance, **kwargs):
     oldname = getattr(instance, "oldname", "None")
     if oldname is None or oldname == instance.name:
         return
+    if operation is not None:
+        operation.domain_renamed(instance, oldname)
+        return
     tr_models.Transport.objects.filter(
         pattern="autoreply.{}".format(oldname)).update(
             pattern="autoreply.{}".format(instance.name))
-    qset = (
-        admin_models.AliasRecipient.objects
-        .select_related("alias", "r_mailbox")
-        .filter(
-            alias__domain=instance, alias__internal=True,
-            address__contains="@autoreply")
-    )
-    for alr in qset:
-        alr.address = alr.address.replace(oldname, instance.name)
-        alr.save()
+    chunk_size = getattr(settings, "AUTOREPLY_RENAME_CHUNK_SIZE", 1000)
+    count = routing.get_domain_routing_recipients(instance, oldname).count()
+    if count <= chunk_size:
+        routing.rename_domain(instance, oldname)
+        return
+    # Don't block the request, wait for the domain to be committed
+    transaction.on_commit(
+        lambda: django_rq.get_queue("modoboa").enqueue(
+            jobs.rename_domain, instance.pk, oldname, chunk_size))
 
 
 @receiver(signals.post_delete, sender=admin_models.Domain)
 def delete_transport_entry(sender, instance, **kwargs):
     """Delete a transport entry."""
+    operation = bulk.get_current()
+    if operation is not None:
+        operation.domain_deleted(instance)
+        return
     tr_models.Transport.objects.filter(
         pattern="autoreply.{}".format(instance)).delete()
 
@@ -55,37 +69,46 @@ def rename_autoreply_alias(sender, instance, **kwargs):
     old_address = getattr(instance, "old_full_address", None)
     if old_address is None or old_address == instance.full_address:
         return
-    admin_models.AliasRecipient.objects.filter(
-        address__contains="{}@autoreply".format(old_address)).update(
-            address="{}@autoreply.{}".format(
-                instance.full_address, instance.domain))
+    operation = bulk.get_current()
+    if operation is not None:
+        operation.mailbox_renamed(old_address, instance)
+        return
+    routing.rename_mailbox(old_address, instance)
 
 
 @receiver(signals.post_delete, sender=admin_models.Mailbox)
 def delete_autoreply_alias(sender, instance, **kwargs):
     """Delete alias."""
-    admin_models.AliasRecipient.objects.filter(
-        address="{}@autoreply.{}".format(
-            instance.full_address, instance.domain)).delete()
+    operation = bulk.get_current()
+    if operation is not None:
+        operation.mailbox_deleted(instance)
+        return
+    routing.remove_routing_alias(instance)
 
 
 @receiver(signals.post_save, sender=models.ARmessage)
 def manage_autoreply_alias(sender, instance, **kwargs):
-    """Create or delete the alias."""
-    ar_alias_address = "{}@autoreply.{}".format(
-        instance.mbox.full_address, instance.mbox.domain)
-    admin_models.Alias.objects.get(
-        address=instance.mbox.full_address, domain=instance.mbox.domain,
-        internal=True)
-    alias, created = admin_models.Alias.objects.get_or_create(
-        address=instance.mbox.full_address, domain=instance.mbox.domain,
-        internal=True)
-    if instance.enabled:
-        admin_models.AliasRecipient.objects.get_or_create(
-            alias=alias, address=ar_alias_address)
-    else:
-        admin_models.AliasRecipient.objects.filter(
-            address=ar_alias_address).delete()
+    """Create or delete the alias if the routing state changed."""
+    update_fields = kwargs.get("update_fields")
+    if update_fields is not None and not (
+            set(update_fields) & set(models.ARmessage.ROUTING_FIELDS)):
+        return
+    if not kwargs.get("created") and not instance.routing_changed():
+        return
+    routing.update_routing_alias(instance)
+    instance.old_routing_state = instance.routing_state
+
+
+@receiver(signals.post_save, sender=models.ARmessage)
+def invalidate_armessage_reply_templates(sender, instance, **kwargs):
+    """Drop precompiled replies of this message."""
+    replies.templates.invalidate(armessage_id=instance.pk)
+
+
+@receiver(signals.post_save, sender=core_models.User)
+def invalidate_user_reply_templates(sender, instance, **kwargs):
+    """Drop precompiled replies of this user."""
+    replies.templates.invalidate(user_id=instance.pk)
 
 
 @receiver(core_signals.extra_uprefs_routes)
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+"""Asynchronous jobs, run by RQ workers (modoboa queue)."""
+
+import logging
+
+from modoboa.admin import models as admin_models
+
+from . import routing
+
+logger = logging.getLogger(__name__)
+
+
+def rename_domain(domain_id, oldname, chunk_size):
+    """Rename routing addresses of a domain by chunks, logging progress."""
+    def progress(done, total):
+        logger.info(
+            "%d/%d autoreply routing addresses of %s renamed", done, total,
+            oldname)
+
+    domain = admin_models.Domain.objects.get(pk=domain_id)
+    try:
+        return routing.rename_domain(domain, oldname, chunk_size, progress)
+    except Exception:
+        logger.exception(
+            "Failed to rename autoreply routing addresses of %s, run "
+            "'autoreply_rename_domain %s %s' to resume", oldname, oldname,
+            domain.name)
+        raise
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+"""Autoreply processing tools shared by management commands."""
+
+import email
+import email.header
+import email.parser
+import logging
+import socket
+from logging.handlers import SysLogHandler
+
+import six
+
+from django.db.models import Q
+from django.utils import timezone
+
+from modoboa.lib.email_utils import split_mailbox
+from modoboa.parameters import tools as param_tools
+from . import classifier, outbox, replies, smtp
+from .models import ARmessage
+
+logger = logging.getLogger(__name__)
+
+# Only headers are kept in memory, the body is read by chunks and
+# discarded.
+MAX_HEADER_LINE_LENGTH = 65536
+MAX_HEADERS_SIZE = 1024 * 1024
+DRAIN_CHUNK_SIZE = 65536
+
+
+def setup_syslog(logger, socket_path, debug=False):
+    """Send logger's records to syslog."""
+    try:
+        handler = SysLogHandler(address=socket_path)
+    except socket.error as ex:
+        if ex.errno == 2:
+            # try the default, localhost:514
+            handler = SysLogHandler()
+        else:
+            raise
+
+    logger.addHandler(handler)
+    logger.setLevel(logging.ERROR)
+    if debug:
+        logger.setLevel(logging.DEBUG)
+
+
+def parse_headers(lines):
+    """Parse message headers from an iterator of lines (bytes).
+
+    Lines are consumed up to the blank line separating headers from
+    the body (included), the remaining ones are left untouched.
+
+    :return: a ``email.message.Message`` instance without payload
+    """
+    headers = []
+    size = 0
+    for line in lines:
+        if line in (b"\r\n", b"\n"):
+            break
+        size += len(line)
+        if size > MAX_HEADERS_SIZE:
+            logger.debug("headers are too big, ignoring the remaining ones")
+            break
+        headers.append(line)
+    return email.parser.BytesHeaderParser().parsebytes(b"".join(headers))
+
+
+def read_message_headers(fp):
+    """Read message headers from a binary stream and drain the body.
+
+    Memory usage does not depend on the message size.
+    """
+    msg = parse_headers(iter(lambda: fp.readline(MAX_HEADER_LINE_LENGTH), b""))
+    drain(fp)
+    return msg
+
+
+def drain(fp):
+    """Read and discard the remaining content of a binary stream."""
+    while fp.read(DRAIN_CHUNK_SIZE):
+        pass
+
+
+def safe_subject(msg):
+    """Clean message subject and return it."""
+    decoded = email.header.decode_header(msg.get("Subject", ""))
+    subject = ""
+    for sub, charset in decoded:
+        if isinstance(sub, six.text_type):
+            subject += sub
+            continue
+        # charset can be None
+        charset = charset if charset else "utf-8"
+        try:
+            subject += sub.decode(charset)
+        except UnicodeDecodeError:
+            pass
+        except LookupError:
+            # Raw 8bit headers are flagged with the unknown-8bit charset
+            subject += sub.decode("utf-8", "replace")
+    return " ".join(subject.split())
+
+
+def is_mailing_list_sender(sender):
+    """Tell if sender looks like a mailing list or a robot."""
+    rule = classifier.get_classifier().match_sender(sender)
+    if rule is not None:
+        logger.debug("sender %s matches bulk rule %s", sender, rule)
+    return rule is not None
+
+
+def is_mailing_list_message(msg):
+    """Tell if msg comes from a mailing list (or is a bulk message)."""
+    header = classifier.get_classifier().match_message(msg)
+    if header is not None:
+        logger.debug("message matches bulk rule %s", header)
+    return header is not None
+
+
+def get_armessages(recipients):
+    """Find enabled auto-reply messages for the given recipients.
+
+    A single query is used, related mailbox, user and domain are
+    fetched at the same time.
+
+    :param list recipients: list of full addresses
+    :return: a dictionary (recipient -> ARmessage)
+    """
+    wanted = {}
+    condition = Q()
+    for fulladdress in recipients:
+        address, domain = split_mailbox(fulladdress)
+        if domain is None:
+            logger.debug("autoreply invalid recipient %s", fulladdress)
+            continue
+        # The database collation may be case insensitive (MySQL)
+        wanted.setdefault((address.lower(), domain.lower()), []).append(
+            fulladdress)
+        condition |= Q(mbox__address=address, mbox__domain__name=domain)
+    if not wanted:
+        return {}
+    qset = (
+        ARmessage.objects.select_related("mbox__user", "mbox__domain")
+        .filter(condition, enabled=True)
+    )
+    result = {}
+    for armessage in qset:
+        key = (
+            armessage.mbox.address.lower(),
+            armessage.mbox.domain.name.lower())
+        for fulladdress in wanted.get(key, []):
+            result.setdefault(fulladdress, armessage)
+    for fulladdress in recipients:
+        if fulladdress in result:
+            logger.debug("autoreply message found for %s", fulladdress)
+        else:
+            logger.debug(
+                "autoreply message not found for %s (unknown recipient or "
+                "no autoreply message)", fulladdress)
+    return result
+
+
+def get_autoreplies_timeout():
+    """Return the minimum delay between two replies to the same sender."""
+    timeout = param_tools.get_global_parameter(
+        "autoreplies_timeout", app="modoboa_postfix_autoreply")
+    return int(timeout)
+
+
+def build_autoreply(sender, mailbox, armessage, original_msg):
+    """Build the autoreply message to send to sender."""
+    message_id = str(original_msg.get("Message-ID", "")).strip("\n")
+    return replies.build_autoreply(
+        sender, mailbox, armessage, safe_subject(original_msg), message_id)
+
+
+def check_activation_window(armessage, now=None):
+    """Tell if armessage is currently active.
+
+    Expired messages are disabled.
+    """
+    if now is None:
+        now = timezone.now()
+    if armessage.fromdate > now:
+        # Too soon, come back later
+        return False
+    if armessage.untildate is not None and armessage.untildate < now:
+        if armessage.enabled:
+            # ARmessage has expired, disable it
+            armessage.enabled = False
+            armessage.save(update_fields=["enabled"])
+        return False
+    return True
+
+
+def deliver(msg, connection=None):
+    """Send msg, or queue it if an outbox is configured.
+
+    :param connection: email backend instance to reuse
+    """
+    spool = outbox.get_outbox()
+    if spool is not None:
+        outbox.enqueue(spool, msg)
+    elif connection is None:
+        msg.send()
+    else:
+        smtp.send_message(msg, connection)
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+"""
+Minimal LMTP server (RFC 2033) used to receive messages from Postfix.
+
+It only implements what Postfix's lmtp(8) client needs: LHLO, MAIL,
+RCPT, DATA, RSET, NOOP and QUIT.
+"""
+
+import contextlib
+import email.utils
+import logging
+import os
+import smtplib
+import socket
+import socketserver
+import stat
+
+from django import db
+from django.core import mail
+
+from . import lib, outbox, pipeline
+
+logger = logging.getLogger(__name__)
+
+MAX_LINE_LENGTH = 8192
+
+
+def parse_address(argument, keyword):
+    """Extract the address from a MAIL/RCPT argument.
+
+    Return None if the argument is not valid.
+    """
+    if not argument.upper().startswith(keyword):
+        return None
+    argument = argument[len(keyword):].strip()
+    if not argument.startswith("<"):
+        return None
+    end = argument.find(">")
+    if end == -1:
+        return None
+    return argument[1:end]
+
+
+def get_mailbox_address(recipient):
+    """Return the mailbox address of an autoreply routing address.
+
+    Routing addresses look like <mailbox>@autoreply.<domain>. Since the
+    mailbox part contains a "@", Postfix usually quotes it
+    (lmtp_quote_rfc821_envelope).
+    """
+    localpart, _sep, domain = recipient.rpartition("@")
+    if localpart and domain.startswith("autoreply."):
+        return email.utils.unquote(localpart)
+    return recipient
+
+
+class LMTPSession(object):
+    """A LMTP session, independent from the underlying transport."""
+
+    def __init__(self, rfile, wfile, hostname=None, smtp_pool=None):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.hostname = hostname or socket.getfqdn()
+        self.smtp_pool = smtp_pool
+        self.reset()
+
+    def reset(self):
+        """Reset transaction state."""
+        self.sender = None
+        self.recipients = []
+
+    def reply(self, *lines):
+        """Send a (possibly multiline) reply."""
+        for line in lines[:-1]:
+            self.wfile.write("{}-{}\r\n".format(
+                line[:3], line[4:]).encode("utf-8"))
+        self.wfile.write("{}\r\n".format(lines[-1]).encode("utf-8"))
+        self.wfile.flush()
+
+    def readline(self):
+        """Read a line, return None on EOF."""
+        line = self.rfile.readline(MAX_LINE_LENGTH)
+        if not line:
+            return None
+        return line
+
+    def run(self):
+        """Handle the session until QUIT or EOF."""
+        self.reply("220 {} LMTP autoreply server ready".format(self.hostname))
+        while True:
+            line = self.readline()
+            if line is None:
+                break
+            line = line.decode("utf-8", "replace").rstrip("\r\n")
+            verb, _sep, argument = line.partition(" ")
+            verb = verb.upper()
+            if verb == "QUIT":
+                self.reply("221 2.0.0 Bye")
+                break
+            handler = getattr(self, "do_{}".format(verb.lower()), None)
+            if handler is None:
+                self.reply("500 5.5.1 Command unrecognized")
+                continue
+            handler(argument.strip())
+
+    def do_lhlo(self, argument):
+        if not argument:
+            self.reply("501 5.5.4 Syntax: LHLO hostname")
+            return
+        self.reset()
+        self.reply(
+            "250 {}".format(self.hostname), "250 PIPELINING",
+            "250 ENHANCEDSTATUSCODES", "250 8BITMIME")
+
+    def do_mail(self, argument):
+        if self.sender is not None:
+            self.reply("503 5.5.1 Nested MAIL command")
+            return
+        address = parse_address(argument, "FROM:")
+        if address is None:
+            self.reply("501 5.5.4 Syntax: MAIL FROM:<address>")
+            return
+        # Same convention than pipe(8) for the null sender
+        self.sender = address or "MAILER-DAEMON"
+        self.reply("250 2.1.0 Ok")
+
+    def do_rcpt(self, argument):
+        if self.sender is None:
+            self.reply("503 5.5.1 Need MAIL command")
+            return
+        address = parse_address(argument, "TO:")
+        if not address:
+            self.reply("501 5.5.4 Syntax: RCPT TO:<address>")
+            return
+        self.recipients.append(address)
+        self.reply("250 2.1.5 Ok")
+
+    def do_rset(self, argument):
+        self.reset()
+        self.reply("250 2.0.0 Ok")
+
+    def do_noop(self, argument):
+        self.reply("250 2.0.0 Ok")
+
+    def read_data(self):
+        """Iterate over the lines of the DATA section.
+
+        Transparency (RFC 5321, section 4.5.2) is removed.
+        """
+        while True:
+            line = self.readline()
+            if line is None or line.rstrip(b"\r\n") == b".":
+                return
+            if line.startswith(b"."):
+                line = line[1:]
+            yield line
+
+    def do_data(self, argument):
+        if not self.recipients:
+            self.reply("503 5.5.1 Need RCPT command")
+            return
+        self.reply("354 End data with <CR><LF>.<CR><LF>")
+        lines = self.read_data()
+        original_msg = lib.parse_headers(lines)
+        for line in lines:
+            # Drain the body
+            pass
+        # LMTP: one reply per accepted recipient
+        for status in self.process(original_msg):
+            self.reply(status)
+        self.reset()
+
+    def process(self, original_msg):
+        """Send autoreplies and return one status per recipient."""
+        ok = "250 2.0.0 <{}> Ok"
+        tempfail = "451 4.3.0 <{}> Temporary failure"
+        recipients = [get_mailbox_address(rcpt) for rcpt in self.recipients]
+        pipe = pipeline.Pipeline(
+            self.sender, recipients, lambda: original_msg)
+        try:
+            candidates = pipe.decide()
+        except db.Error:
+            logger.exception("Failed to fetch autoreply messages")
+            return [tempfail.format(rcpt) for rcpt in self.recipients]
+        if not candidates:
+            return [ok.format(rcpt) for rcpt in self.recipients]
+        if outbox.get_outbox() is not None:
+            # Replies are queued, no connection needed
+            connection_manager = contextlib.nullcontext()
+        elif self.smtp_pool is None:
+            connection_manager = mail.get_connection()
+        else:
+            connection_manager = self.smtp_pool.connection()
+        try:
+            with connection_manager as connection:
+                failures = pipe.send(candidates, connection)
+        except (smtplib.SMTPException, OSError):
+            logger.exception("Failed to open SMTP connection")
+            pipe.release(candidates)
+            return [tempfail.format(rcpt) for rcpt in self.recipients]
+        return [
+            (tempfail if fulladdress in failures else ok).format(rcpt)
+            for rcpt, fulladdress in zip(self.recipients, recipients)
+        ]
+
+
+class LMTPRequestHandler(socketserver.StreamRequestHandler):
+    """Run a LMTP session inside a server thread."""
+
+    def handle(self):
+        try:
+            LMTPSession(
+                self.rfile, self.wfile, self.server.hostname,
+                self.server.smtp_pool).run()
+        except Exception:
+            logger.exception("LMTP session aborted")
+
+    def finish(self):
+        super(LMTPRequestHandler, self).finish()
+        # Database connections are per thread, don't leak them
+        db.connections.close_all()
+
+
+class LMTPServerMixin(object):
+    """Shared by LMTP servers."""
+
+    daemon_threads = True
+    hostname = None
+    smtp_pool = None
+
+    def service_actions(self):
+        if self.smtp_pool is not None:
+            self.smtp_pool.close_idle()
+
+    def server_close(self):
+        super(LMTPServerMixin, self).server_close()
+        if self.smtp_pool is not None:
+            self.smtp_pool.close_all()
+
+
+class ThreadingLMTPServer(LMTPServerMixin, socketserver.ThreadingTCPServer):
+    """LMTP server listening on a TCP socket."""
+
+    allow_reuse_address = True
+
+
+class ThreadingUnixLMTPServer(
+        LMTPServerMixin, socketserver.ThreadingUnixStreamServer):
+    """LMTP server listening on a UNIX socket."""
+
+    def __init__(self, path, *args, **kwargs):
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+        super(ThreadingUnixLMTPServer, self).__init__(path, *args, **kwargs)
+
+    def server_close(self):
+        super(ThreadingUnixLMTPServer, self).server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def create_server(endpoint, socket_mode=None, smtp_pool=None):
+    """Create a LMTP server from a Postfix like endpoint definition.
+
+    Supported syntaxes are ``unix:/path/to/socket`` and
+    ``inet:host:port``.
+    """
+    kind, _sep, address = endpoint.partition(":")
+    if kind == "unix" and address:
+        server = ThreadingUnixLMTPServer(address, LMTPRequestHandler)
+        if socket_mode is not None:
+            os.chmod(address, socket_mode)
+    elif kind == "inet" and address:
+        host, _sep, port = address.rpartition(":")
+        server = ThreadingLMTPServer(
+            (host or "localhost", int(port)), LMTPRequestHandler)
+    else:
+        raise ValueError("Invalid endpoint: {}".format(endpoint))
+    server.hostname = socket.getfqdn()
+    server.smtp_pool = smtp_pool
+    return server
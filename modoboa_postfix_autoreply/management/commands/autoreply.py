@@ -1,119 +1,37 @@
 # -*- coding: utf-8 -*-
 
-import datetime
-import email
-import email.header
-import fileinput
+import io
 import logging
 import smtplib
-import socket
 import sys
-from logging.handlers import SysLogHandler
 
-import six
-
-from django.core.mail import EmailMessage
-from django.core.management.base import BaseCommand
-from django.utils import timezone, translation
+from django.conf import settings
+from django.db import Error as DatabaseError
+from django.core.management.base import BaseCommand, CommandError
 from django.utils.encoding import smart_str
-from django.utils.formats import localize
 
-from modoboa.admin.models import Mailbox
-from modoboa.lib.email_utils import split_mailbox
-from modoboa.parameters import tools as param_tools
-from ...models import ARhistoric, ARmessage
+from ... import batch, breaker, metrics, profiling, spool
+from ...lib import (  # NOQA:F401
+    drain, is_mailing_list_message, is_mailing_list_sender,
+    read_message_headers, safe_subject, setup_syslog
+)
 from ...modo_extension import PostfixAutoreply
+from ...pipeline import Pipeline
 
 logger = logging.getLogger()
 
+# Tell Postfix to defer the delivery (see sysexits.h)
+EX_TEMPFAIL = 75
 
-def safe_subject(msg):
-    """Clean message subject and return it."""
-    decoded = email.header.decode_header(msg.get("Subject"))
-    subject = ""
-    for sub, charset in decoded:
-        if isinstance(sub, six.text_type):
-            subject += sub
-            continue
-        # charset can be None
-        charset = charset if charset else "utf-8"
-        try:
-            subject += sub.decode(charset)
-        except UnicodeDecodeError:
-            pass
-    return " ".join(subject.split())
-
-
-def send_autoreply(sender, mailbox, armessage, original_msg):
-    """Send an autoreply message."""
-    if armessage.fromdate > timezone.now():
-        # Too soon, come back later
-        return
-
-    condition = (
-        armessage.untildate is not None and
-        armessage.untildate < timezone.now())
-    if condition:
-        # ARmessage has expired, disable it
-        armessage.enabled = False
-        armessage.save(update_fields=["enabled"])
-        return
-
-    try:
-        lastar = ARhistoric.objects.get(armessage=armessage.id, sender=sender)
-        timeout = param_tools.get_global_parameter(
-            "autoreplies_timeout", app="modoboa_postfix_autoreply")
-        delta = datetime.timedelta(seconds=int(timeout))
-        now = timezone.make_aware(datetime.datetime.now(),
-                                  timezone.get_default_timezone())
-        if lastar.last_sent + delta > now:
-            logger.debug(
-                "no autoreply message sent because delta (%s) < timetout (%s)",
-                delta, timeout
-            )
-            return
 
-    except ARhistoric.DoesNotExist:
-        lastar = ARhistoric()
-        lastar.armessage = armessage
-        lastar.sender = sender
-
-    headers = {
-        "Auto-Submitted": "auto-replied",
-        "Precedence": "bulk"
-    }
-    message_id = original_msg.get("Message-ID","").strip("\n")
-    if message_id:
-        headers.update({"In-Reply-To": message_id, "References": message_id})
-
-    subject = safe_subject(original_msg)
-    with translation.override(mailbox.user.language):
-        context = {
-            "name": mailbox.user.fullname,
-            "fromdate": localize(armessage.fromdate),
-            "untildate": ""
-        }
-        if armessage.untildate:
-            context.update({"untildate": localize(armessage.untildate)})
-    content = armessage.content % context
-    msg = EmailMessage(
-        "Auto: {} Re: {}".format(armessage.subject, subject),
-        smart_str(content),
-        mailbox.user.encoded_address,
-        [sender],
-        headers=headers
-    )
-    try:
-        msg.send()
-    except smtplib.SMTPException as exp:
-        logger.error("Failed to send autoreply message: %s", exp)
-        sys.exit(1)
-
-    logger.debug(
-        "autoreply message sent to %s", mailbox.user.encoded_address)
-
-    lastar.last_sent = datetime.datetime.now()
-    lastar.save()
+def is_permanent(exc):
+    """Tell if retrying to send a reply is pointless."""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, msg in exc.recipients.values())
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return exc.smtp_code >= 500
+    # Rendering errors won't go away either
+    return not isinstance(exc, (smtplib.SMTPException, OSError))
 
 
 class Command(BaseCommand):
@@ -130,85 +48,124 @@ class Command(BaseCommand):
             "--syslog-socket-path", default="/dev/log",
             help="Path to syslog socket"
         )
-        parser.add_argument("sender")
-        parser.add_argument("recipient", nargs="+")
+        parser.add_argument(
+            "--concurrency", type=int,
+            help="Maximum number of replies sent at the same time for a "
+                 "multi-recipient message (default: "
+                 "AUTOREPLY_SEND_CONCURRENCY setting or 4)"
+        )
+        parser.add_argument(
+            "--profile-dir",
+            help="Write cProfile statistics (.pstats files) to this directory"
+        )
+        parser.add_argument(
+            "--profile-sample-rate", type=float,
+            help="Fraction of invocations to profile (default: 1)"
+        )
+        parser.add_argument(
+            "--deadline", type=float,
+            help="Defer the message if it can't be processed within this "
+                 "number of seconds (default: AUTOREPLY_DEADLINE setting)"
+        )
+        parser.add_argument(
+            "--spool-dir",
+            help="Process messages queued in this directory by "
+                 "spoolclient.py instead of reading stdin"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=100,
+            help="Number of spooled messages processed at once"
+        )
+        parser.add_argument(
+            "--loop", action="store_true", default=False,
+            help="Keep waiting for new spooled messages"
+        )
+        parser.add_argument(
+            "--recover-after", type=int, default=3600,
+            help="Give back spooled messages claimed for more than this "
+                 "number of seconds (crashed consumer)"
+        )
+        parser.add_argument("sender", nargs="?")
+        parser.add_argument("recipient", nargs="*")
 
     def handle(self, *args, **options):
-        try:
-            handler = SysLogHandler(address=options["syslog_socket_path"])
-        except socket.error as ex:
-            if ex.errno == 2:
-                # try the default, localhost:514
-                handler = SysLogHandler()
-            else:
-                raise
-
-        logger.addHandler(handler)
-        logger.setLevel(logging.ERROR)
-        if options["debug"]:
-            logger.setLevel(logging.DEBUG)
-
+        setup_syslog(logger, options["syslog_socket_path"], options["debug"])
+        if options["spool_dir"]:
+            self.process_spool(**options)
+            return
+        if not options["sender"] or not options["recipient"]:
+            raise CommandError("sender and recipient arguments are required")
+        with profiling.sampled_profile(*profiling.get_profile_settings(
+                options["profile_dir"], options["profile_sample_rate"])):
+            self.process(**options)
+
+    def process_spool(self, **options):
+        """Process messages queued by spoolclient.py."""
+        PostfixAutoreply().load()
+        queue = spool.Spool(options["spool_dir"])
+        recovered = queue.recover(options["recover_after"])
+        if recovered:
+            logger.warning("%d spooled message(s) recovered", recovered)
+        batch.run(
+            queue, batch_size=options["batch_size"], loop=options["loop"])
+
+    def process(self, **options):
+        """Decide and send replies for the message read on stdin."""
         logger.debug(
             "autoreply sender=%s recipient=%s",
             options["sender"], ",".join(options["recipient"])
         )
 
         sender = smart_str(options["sender"])
+        recipients = [smart_str(rcpt) for rcpt in options["recipient"]]
 
-        sender_localpart = split_mailbox(sender.lower())[0]
-        if (
-            (sender_localpart in ("mailer-daemon", "listserv", "majordomo")) or
-            (sender_localpart.startswith("owner-")) or
-            (sender_localpart.endswith("-request"))
-        ):
-            logger.debug(
-                "Skip auto reply, this mail comes from a mailing list")
-            return
+        stdin = getattr(sys.stdin, "buffer", None)
+        if stdin is None:
+            # Text stream without binary buffer (tests)
+            stdin = io.BytesIO(sys.stdin.read().encode("utf-8"))
 
-        content = six.StringIO()
-        for line in fileinput.input([]):
-            content.write(line)
-        content.seek(0)
-
-        original_msg = email.message_from_file(content)
-
-        # Mailing list filter based on
-        # https://tools.ietf.org/html/rfc5230#page-7
-        ml_known_headers = [
-            "List-Id", "List-Help", "List-Subscribe", "List-Unsubscribe",
-            "List-Post", "List-Owner", "List-Archive"
-        ]
-        from_ml = False
-        for header in ml_known_headers:
-            if header in original_msg:
-                from_ml = True
-                break
-        condition = (
-            original_msg.get("Precedence") == "bulk" or
-            original_msg.get("X-Mailer") == "PHPMailer" or
-            from_ml
-        )
-        if condition:
-            logger.debug(
-                "Skip auto reply, this mail comes from a mailing list")
-            return
+        circuit_breaker = breaker.get_breaker()
+        if circuit_breaker is not None and not circuit_breaker.allow():
+            logger.warning("circuit breaker open, deferring message")
+            drain(stdin)
+            sys.exit(EX_TEMPFAIL)
 
         PostfixAutoreply().load()
-        recipients = [smart_str(rcpt) for rcpt in options["recipient"]]
-        for fulladdress in recipients:
-            address, domain = split_mailbox(fulladdress)
-            try:
-                mbox = Mailbox.objects.get(
-                    address=address, domain__name=domain)
-            except Mailbox.DoesNotExist:
-                msg = "Unknown recipient %s" % (fulladdress)
-                logger.debug("autoreply %s", msg)
-                continue
-            try:
-                armessage = ARmessage.objects.get(mbox=mbox.id, enabled=True)
-                logger.debug("autoreply message found")
-            except ARmessage.DoesNotExist:
-                logger.debug("autoreply message not found")
-                continue
-
-            send_autoreply(sender, mbox, armessage, original_msg)
+        # The message is only read if no cheaper check rejected it
+        concurrency = options["concurrency"]
+        if concurrency is None:
+            concurrency = getattr(settings, "AUTOREPLY_SEND_CONCURRENCY", 4)
+        pipeline = Pipeline(
+            sender, recipients, lambda: read_message_headers(stdin),
+            concurrency=concurrency)
+        seconds = options["deadline"]
+        if seconds is None:
+            seconds = getattr(settings, "AUTOREPLY_DEADLINE", None)
+        tempfail = False
+        try:
+            with breaker.deadline(seconds):
+                failures = pipeline.run()
+        except (DatabaseError, breaker.DeadlineExceeded) as exc:
+            logger.error("autoreply deferred: %s", exc)
+            failures = {}
+            tempfail = True
+        finally:
+            metrics.flush()
+        if pipeline.original_msg is None:
+            # Don't let Postfix write to a closed pipe
+            drain(stdin)
+        permanent = {
+            rcpt: exc for rcpt, exc in failures.items() if is_permanent(exc)
+        }
+        if permanent:
+            # Bouncing would notify the original sender, just give up
+            logger.error(
+                "giving up autoreply message for %s", ", ".join(permanent))
+        tempfail = tempfail or len(failures) > len(permanent)
+        if circuit_breaker is not None:
+            if tempfail:
+                circuit_breaker.record_failure()
+            else:
+                circuit_breaker.record_success()
+        if tempfail:
+            sys.exit(EX_TEMPFAIL)
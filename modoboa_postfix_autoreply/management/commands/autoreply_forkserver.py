@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""Fork server used to run the autoreply command without startup cost."""
+
+import signal
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import forkserver
+from ...lib import setup_syslog
+
+
+class Command(BaseCommand):
+    """Command definition."""
+
+    help = "Start a fork server running autoreply commands"  # NOQA:A003
+
+    def add_arguments(self, parser):
+        """Add extra arguments to command line."""
+        parser.add_argument(
+            "--socket", default="/var/run/modoboa/autoreply-fork.sock",
+            help="Path to the UNIX socket to listen on"
+        )
+        parser.add_argument(
+            "--socket-mode", default="0660",
+            help="Permissions applied to the UNIX socket (octal)"
+        )
+        parser.add_argument(
+            "--max-children", type=int, default=32,
+            help="Maximum number of concurrent children"
+        )
+        parser.add_argument(
+            "--debug", action="store_true", dest="debug", default=False
+        )
+        parser.add_argument(
+            "--syslog-socket-path", default="/dev/log",
+            help="Path to syslog socket"
+        )
+
+    def handle(self, *args, **options):
+        # Children configure the root logger themselves
+        forkserver.logger.propagate = False
+        setup_syslog(
+            forkserver.logger, options["syslog_socket_path"],
+            options["debug"])
+        try:
+            server = forkserver.ForkServer(
+                options["socket"], int(options["socket_mode"], 8),
+                options["max_children"])
+        except (OSError, ValueError) as exc:
+            raise CommandError(exc)
+        server.warmup()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        forkserver.logger.info(
+            "autoreply fork server listening on %s", options["socket"])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+"""Send autoreply messages waiting in the outbox."""
+
+import logging
+import signal
+import sys
+import time
+
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import outbox
+from ...lib import setup_syslog
+
+logger = logging.getLogger()
+
+
+class Command(BaseCommand):
+    """Command definition."""
+
+    help = "Send queued autoreply messages"  # NOQA:A003
+
+    def add_arguments(self, parser):
+        """Add extra arguments to command line."""
+        parser.add_argument(
+            "--loop", action="store_true", default=False,
+            help="Run forever, checking the outbox every INTERVAL seconds"
+        )
+        parser.add_argument(
+            "--interval", type=float, default=1,
+            help="Delay (in seconds) between two checks in loop mode"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=100,
+            help="Maximum number of messages sent per SMTP session"
+        )
+        parser.add_argument(
+            "--max-attempts", type=int, default=outbox.DEFAULT_MAX_ATTEMPTS,
+            help="Number of attempts before giving up a message"
+        )
+        parser.add_argument(
+            "--backoff", type=int, default=outbox.DEFAULT_BACKOFF,
+            help="Delay (in seconds) before the first retry, doubled at "
+                 "each attempt"
+        )
+        parser.add_argument(
+            "--recover-after", type=int, default=600,
+            help="Requeue messages claimed by a worker more than "
+                 "RECOVER_AFTER seconds ago (crashed worker)"
+        )
+        parser.add_argument(
+            "--debug", action="store_true", dest="debug", default=False
+        )
+        parser.add_argument(
+            "--syslog-socket-path", default="/dev/log",
+            help="Path to syslog socket"
+        )
+
+    def run_once(self, spool, **options):
+        """Empty the outbox, return True if something was sent."""
+        total_sent = 0
+        # Same SMTP session for all batches, opened on first use
+        connection = mail.get_connection()
+        try:
+            while True:
+                sent, deferred, failed = outbox.flush(
+                    spool, options["batch_size"], options["max_attempts"],
+                    options["backoff"], connection)
+                total_sent += sent
+                if options["verbosity"] > 1 and (sent or deferred or failed):
+                    self.stdout.write(
+                        "{} message(s) sent, {} deferred, {} failed".format(
+                            sent, deferred, failed))
+                if not sent or deferred:
+                    break
+        finally:
+            connection.close()
+        return total_sent
+
+    def handle(self, *args, **options):
+        setup_syslog(logger, options["syslog_socket_path"], options["debug"])
+        spool = outbox.get_outbox()
+        if spool is None:
+            raise CommandError("AUTOREPLY_OUTBOX_DIR is not defined")
+        spool.recover(options["recover_after"])
+        if not options["loop"]:
+            self.run_once(spool, **options)
+            return
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        last_recover = time.monotonic()
+        try:
+            while True:
+                if not self.run_once(spool, **options):
+                    time.sleep(options["interval"])
+                if time.monotonic() - last_recover > options["recover_after"]:
+                    spool.recover(options["recover_after"])
+                    last_recover = time.monotonic()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+"""Merge profiles written by the autoreply command."""
+
+import io
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import profiling
+
+SORT_KEYS = ["cumulative", "tottime", "calls", "ncalls", "time"]
+
+
+class Command(BaseCommand):
+    """Command definition."""
+
+    help = "Display the hotspots of collected autoreply profiles"  # NOQA:A003
+
+    def add_arguments(self, parser):
+        """Add extra arguments to command line."""
+        parser.add_argument(
+            "directory", help="Directory containing .pstats files"
+        )
+        parser.add_argument(
+            "--sort", choices=SORT_KEYS, default="cumulative",
+            help="Sort functions by this column"
+        )
+        parser.add_argument(
+            "--limit", type=int, default=30,
+            help="Number of functions to display"
+        )
+        parser.add_argument(
+            "--output", help="Also save merged statistics to this file"
+        )
+
+    def handle(self, *args, **options):
+        stats, count = profiling.load_profiles(options["directory"])
+        if stats is None:
+            raise CommandError(
+                "No profile found in {}".format(options["directory"]))
+        if options["output"]:
+            stats.dump_stats(options["output"])
+        buf = io.StringIO()
+        stats.stream = buf
+        # Don't list every merged file
+        stats.files = []
+        self.stdout.write(
+            "{} profile(s), {:.3f}s per invocation on average".format(
+                count, stats.total_tt / count))
+        stats.strip_dirs().sort_stats(options["sort"]).print_stats(
+            options["limit"])
+        self.stdout.write(buf.getvalue())
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+"""Delete useless autoreply history."""
+
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ...lib import get_autoreplies_timeout
+from ...models import ARhistoric
+from ...modo_extension import PostfixAutoreply
+
+
+class Command(BaseCommand):
+    """Command definition."""
+
+    help = "Delete expired autoreply history"  # NOQA:A003
+
+    def add_arguments(self, parser):
+        """Add extra arguments to command line."""
+        parser.add_argument(
+            "--dry-run", action="store_true", default=False,
+            help="Only count entries that would be deleted"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=1000,
+            help="Number of entries deleted per statement"
+        )
+        parser.add_argument(
+            "--sleep", type=float, default=0,
+            help="Pause (in seconds) between two batches"
+        )
+        parser.add_argument(
+            "--older-than", type=int,
+            help="Age (in seconds) of entries to delete. Default to the "
+                 "automatic reply timeout"
+        )
+
+    def delete_by_batch(self, qset, label, **options):
+        """Delete entries matching qset by bounded batches."""
+        if options["dry_run"]:
+            count = qset.count()
+            self.stdout.write("{}: {} entries to delete".format(label, count))
+            return count
+        deleted = 0
+        while True:
+            pks = list(
+                qset.values_list("pk", flat=True)[:options["batch_size"]])
+            if not pks:
+                break
+            count, details = ARhistoric.objects.filter(pk__in=pks).delete()
+            deleted += count
+            if options["verbosity"] > 1:
+                self.stdout.write(
+                    "{}: {} entries deleted".format(label, deleted))
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+        if options["verbosity"]:
+            self.stdout.write("{}: {} entries deleted".format(label, deleted))
+        return deleted
+
+    def handle(self, *args, **options):
+        older_than = options["older_than"]
+        if older_than is None:
+            PostfixAutoreply().load()
+            older_than = get_autoreplies_timeout()
+        threshold = timezone.now() - datetime.timedelta(seconds=older_than)
+        # History of deleted messages is removed by cascade
+        self.delete_by_batch(
+            ARhistoric.objects.filter(armessage__enabled=False),
+            "Disabled messages", **options)
+        self.delete_by_batch(
+            ARhistoric.objects.filter(last_sent__lt=threshold),
+            "Expired entries", **options)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+"""Make routing aliases match active auto-reply messages."""
+
+from django.core.management.base import BaseCommand
+
+from ... import reconcile
+
+
+class Command(BaseCommand):
+    """Command definition."""
+
+    help = (  # NOQA:A003
+        "Create missing and delete stale autoreply routing aliases"
+    )
+
+    def add_arguments(self, parser):
+        """Add extra arguments to command line."""
+        parser.add_argument(
+            "--dry-run", action="store_true", default=False,
+            help="Only display differences"
+        )
+        parser.add_argument(
+            "--chunk-size", type=int, default=reconcile.CHUNK_SIZE,
+            help="Number of rows changed per statement"
+        )
+
+    def handle(self, *args, **options):
+        def report(action, address):
+            if options["verbosity"] > 1 or options["dry_run"]:
+                self.stdout.write("{} {}".format(
+                    "+" if action == "add" else "-", address))
+
+        added, removed = reconcile.reconcile(
+            dry_run=options["dry_run"], chunk_size=options["chunk_size"],
+            report=report)
+        if options["verbosity"]:
+            self.stdout.write(
+                "{} routing alias(es) {}, {} {}".format(
+                    added,
+                    "to create" if options["dry_run"] else "created",
+                    removed,
+                    "to delete" if options["dry_run"] else "deleted"))
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+"""Update routing addresses of a renamed domain."""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from modoboa.admin import models as admin_models
+
+from ... import routing
+
+
+class Command(BaseCommand):
+    """Command definition."""
+
+    help = (  # NOQA:A003
+        "Update autoreply routing addresses after a domain rename (resume "
+        "an interrupted background update)"
+    )
+
+    def add_arguments(self, parser):
+        """Add extra arguments to command line."""
+        parser.add_argument("oldname", help="Previous name of the domain")
+        parser.add_argument("newname", help="Current name of the domain")
+        parser.add_argument(
+            "--chunk-size", type=int, default=1000,
+            help="Number of addresses updated per transaction"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            domain = admin_models.Domain.objects.get(name=options["newname"])
+        except admin_models.Domain.DoesNotExist:
+            raise CommandError(
+                "Domain {} not found".format(options["newname"]))
+
+        def progress(done, total):
+            if options["verbosity"]:
+                self.stdout.write("{}/{} address(es) updated".format(
+                    done, total))
+
+        done = routing.rename_domain(
+            domain, options["oldname"], options["chunk_size"], progress)
+        if options["verbosity"] and not done:
+            self.stdout.write("Nothing to update")
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+"""Replay a corpus of messages through the autoreply pipeline."""
+
+import collections
+import csv
+import email.utils
+import io
+import mailbox
+import os
+import queue
+import statistics
+import threading
+import time
+
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import override_settings
+
+from ... import metrics, outbox
+from ...lib import read_message_headers
+from ...modo_extension import PostfixAutoreply
+from ...pipeline import Pipeline
+
+RECIPIENT_HEADERS = ["Delivered-To", "X-Original-To", "To", "Cc"]
+
+
+def read_file(path):
+    with open(path, "rb") as fp:
+        return fp.read()
+
+
+def load_corpus(path, limit=None):
+    """Return the raw content of the messages found in path.
+
+    path can be a maildir, a mbox file or a directory of .eml files.
+    """
+    if os.path.isfile(path):
+        source = (
+            msg.as_bytes() for msg in mailbox.mbox(path, create=False))
+    elif os.path.isdir(os.path.join(path, "cur")):
+        source = (
+            msg.as_bytes() for msg in mailbox.Maildir(path, create=False))
+    elif os.path.isdir(path):
+        source = (
+            read_file(os.path.join(path, name))
+            for name in sorted(os.listdir(path)) if name.endswith(".eml"))
+    else:
+        raise CommandError("{} not found".format(path))
+    result = []
+    for content in source:
+        result.append(content)
+        if limit and len(result) >= limit:
+            break
+    return result
+
+
+def load_mapping(path):
+    """Read a CSV file of (original address, replayed address) pairs."""
+    with open(path) as fp:
+        return {
+            row[0].strip().lower(): row[1].strip()
+            for row in csv.reader(fp) if len(row) >= 2
+        }
+
+
+class Command(BaseCommand):
+    """Command definition."""
+
+    help = (  # NOQA:A003
+        "Replay messages through the autoreply logic and report "
+        "performance figures. Replies are recorded in the database like "
+        "real ones: use a test database."
+    )
+
+    def add_arguments(self, parser):
+        """Add extra arguments to command line."""
+        parser.add_argument(
+            "corpus", help="A maildir, a mbox file or a directory of .eml "
+                           "files")
+        parser.add_argument(
+            "--mapping",
+            help="CSV file mapping corpus addresses (first column) to "
+                 "replayed ones (second column)"
+        )
+        parser.add_argument(
+            "--sender", help="Envelope sender used for all messages"
+        )
+        parser.add_argument(
+            "--recipient", action="append",
+            help="Envelope recipient used for all messages (repeatable)"
+        )
+        parser.add_argument(
+            "--workers", type=int, default=1,
+            help="Number of concurrent workers"
+        )
+        parser.add_argument(
+            "--rate", type=float,
+            help="Target rate (messages per second). Default to as fast "
+                 "as possible"
+        )
+        parser.add_argument(
+            "--limit", type=int, help="Maximum number of messages to replay"
+        )
+        parser.add_argument(
+            "--email-backend",
+            default="django.core.mail.backends.locmem.EmailBackend",
+            help="Email backend used to send replies"
+        )
+
+    def get_envelope(self, content, mapping, **options):
+        """Return the (sender, recipients) pair to use for a message."""
+        msg = read_message_headers(io.BytesIO(content))
+        sender = options["sender"]
+        if sender is None:
+            sender = email.utils.parseaddr(
+                msg.get("Return-Path") or msg.get("From", ""))[1]
+            sender = mapping.get(sender.lower(), sender)
+        recipients = options["recipient"]
+        if not recipients:
+            recipients = []
+            for header in RECIPIENT_HEADERS:
+                for name, address in email.utils.getaddresses(
+                        [str(value) for value in msg.get_all(header, [])]):
+                    address = mapping.get(address.lower(), address)
+                    if address and address not in recipients:
+                        recipients.append(address)
+                if recipients:
+                    break
+            if mapping:
+                mapped = set(mapping.values())
+                recipients = [rcpt for rcpt in recipients if rcpt in mapped]
+        return sender, recipients
+
+    def replay(self, sender, recipients, content, connection):
+        """Process one message, return (outcome, latency)."""
+        start = time.perf_counter()
+        pipeline = Pipeline(
+            sender, recipients,
+            lambda: read_message_headers(io.BytesIO(content)))
+        try:
+            candidates = pipeline.decide()
+            failures = {}
+            if candidates:
+                failures = pipeline.send(candidates, connection)
+        except Exception as exc:
+            return (
+                "error ({})".format(type(exc).__name__),
+                time.perf_counter() - start)
+        latency = time.perf_counter() - start
+        if failures:
+            outcome = "failed"
+        elif pipeline.rejected_by is not None:
+            outcome = "rejected by {}".format(pipeline.rejected_by)
+        else:
+            outcome = "sent"
+        if hasattr(mail, "outbox"):
+            # Don't keep replies in memory (locmem backend)
+            del mail.outbox[:]
+        return outcome, latency
+
+    def worker(self, jobs, results, start, **options):
+        rate = options["rate"]
+        connection = mail.get_connection(options["email_backend"])
+        try:
+            while True:
+                try:
+                    index, sender, recipients, content = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                if rate:
+                    delay = start + index / rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                results.append(
+                    self.replay(sender, recipients, content, connection))
+        finally:
+            connection.close()
+
+    def worker_thread(self, *args, **kwargs):
+        try:
+            self.worker(*args, **kwargs)
+        finally:
+            # Close this thread's database connections
+            connections.close_all()
+
+    def run_workers(self, jobs, results, start, **options):
+        if options["workers"] == 1:
+            self.worker(jobs, results, start, **options)
+            return
+        threads = [
+            threading.Thread(
+                target=self.worker_thread, args=(jobs, results, start),
+                kwargs=options)
+            for i in range(options["workers"])
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def report(self, results, elapsed):
+        latencies = sorted(latency for outcome, latency in results)
+        count = len(latencies)
+
+        def percentile(value):
+            return latencies[min(count - 1, int(count * value))] * 1000
+
+        self.stdout.write(
+            "{} messages in {:.2f}s: {:.1f} msg/s".format(
+                count, elapsed, count / elapsed if elapsed else 0))
+        self.stdout.write(
+            "Latency (ms): min={:.2f} mean={:.2f} p50={:.2f} p90={:.2f} "
+            "p99={:.2f} max={:.2f}".format(
+                latencies[0] * 1000, statistics.mean(latencies) * 1000,
+                percentile(0.5), percentile(0.9), percentile(0.99),
+                latencies[-1] * 1000))
+        self.stdout.write("Outcomes:")
+        outcomes = collections.Counter(outcome for outcome, latency in results)
+        for outcome, number in outcomes.most_common():
+            self.stdout.write("  {}: {} ({:.1f}%)".format(
+                outcome, number, number * 100 / count))
+        skipped = metrics.registry.collect()[
+            metrics.recipients_skipped.name]
+        if skipped:
+            self.stdout.write("Skipped recipients:")
+            for sample, number in sorted(skipped.items()):
+                self.stdout.write("  {}: {}".format(
+                    sample.split('"')[1], number))
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1:
+            raise CommandError("--workers must be greater than 0")
+        PostfixAutoreply().load()
+        mapping = (
+            load_mapping(options["mapping"]) if options["mapping"] else {})
+        jobs = queue.Queue()
+        for content in load_corpus(options["corpus"], options["limit"]):
+            sender, recipients = self.get_envelope(content, mapping, **options)
+            if not recipients:
+                continue
+            jobs.put((jobs.qsize(), sender, recipients, content))
+        if jobs.empty():
+            raise CommandError("No message to replay")
+        metrics.registry.collect(reset=True)
+        results = []
+        # Replies must not reach the real outbox
+        outbox.get_outbox.cache_clear()
+        try:
+            with override_settings(AUTOREPLY_OUTBOX_DIR=None):
+                start = time.perf_counter()
+                self.run_workers(jobs, results, start, **options)
+                elapsed = time.perf_counter() - start
+        finally:
+            outbox.get_outbox.cache_clear()
+        self.report(results, elapsed)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+"""Apply auto-reply messages activations and expirations."""
+
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from ... import scheduler
+
+
+class Command(BaseCommand):
+    """Command definition."""
+
+    help = "Activate and expire autoreply messages"  # NOQA:A003
+
+    def add_arguments(self, parser):
+        """Add extra arguments to command line."""
+        parser.add_argument(
+            "--loop", action="store_true", default=False,
+            help="Run forever, waking up at each transition"
+        )
+        parser.add_argument(
+            "--lookback", type=int, default=3600,
+            help="Look for activations which occurred during the last "
+                 "LOOKBACK seconds (must be greater than the cron period)"
+        )
+        parser.add_argument(
+            "--all", action="store_true", default=False,
+            help="Check all active messages on first run"
+        )
+        parser.add_argument(
+            "--max-sleep", type=int, default=60,
+            help="Maximum delay (in seconds) between two checks in loop mode"
+        )
+
+    def run_once(self, now, since, **options):
+        activated, expired = scheduler.apply_transitions(now, since)
+        if options["verbosity"] > 1 or (
+                options["verbosity"] and (activated or expired)):
+            self.stdout.write(
+                "{}: {} message(s) activated, {} message(s) expired".format(
+                    now, activated, expired))
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        since = None
+        if not options["all"]:
+            since = now - datetime.timedelta(seconds=options["lookback"])
+        self.run_once(now, since, **options)
+        if not options["loop"]:
+            return
+        max_sleep = datetime.timedelta(seconds=options["max_sleep"])
+        while True:
+            wakeup = now + max_sleep
+            next_date = scheduler.next_transition(now)
+            if next_date is not None and next_date < wakeup:
+                wakeup = next_date
+            close_old_connections()
+            delay = (wakeup - timezone.now()).total_seconds()
+            if delay > 0:
+                time.sleep(delay)
+            since, now = now, timezone.now()
+            self.run_once(now, since, **options)
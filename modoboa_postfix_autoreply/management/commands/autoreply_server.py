@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""Long-running LMTP server sending autoreply messages."""
+
+import logging
+import signal
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from ... import metrics
+from ...lib import setup_syslog
+from ...lmtp import create_server
+from ...modo_extension import PostfixAutoreply
+from ...smtp import ConnectionPool
+
+logger = logging.getLogger()
+
+
+class Command(BaseCommand):
+    """Command definition."""
+
+    help = "Start a LMTP server sending autoreply emails"  # NOQA:A003
+
+    def add_arguments(self, parser):
+        """Add extra arguments to command line."""
+        parser.add_argument(
+            "--lmtp", default="unix:/var/run/modoboa/autoreply.sock",
+            help="Listening endpoint (unix:/path or inet:host:port)"
+        )
+        parser.add_argument(
+            "--socket-mode", default="0660",
+            help="Permissions applied to the UNIX socket (octal)"
+        )
+        parser.add_argument(
+            "--smtp-pool-size", type=int, default=4,
+            help="Maximum number of outgoing SMTP connections"
+        )
+        parser.add_argument(
+            "--smtp-idle-timeout", type=int, default=60,
+            help="Close outgoing SMTP connections idle for this number "
+                 "of seconds"
+        )
+        parser.add_argument(
+            "--metrics-listen",
+            help="Serve Prometheus metrics on http://HOST:PORT/metrics"
+        )
+        parser.add_argument(
+            "--debug", action="store_true", dest="debug", default=False
+        )
+        parser.add_argument(
+            "--syslog-socket-path", default="/dev/log",
+            help="Path to syslog socket"
+        )
+
+    def handle(self, *args, **options):
+        setup_syslog(logger, options["syslog_socket_path"], options["debug"])
+        PostfixAutoreply().load()
+        try:
+            server = create_server(
+                options["lmtp"], int(options["socket_mode"], 8),
+                ConnectionPool(
+                    options["smtp_pool_size"], options["smtp_idle_timeout"])
+            )
+        except (OSError, ValueError) as exc:
+            raise CommandError(exc)
+        if options["metrics_listen"]:
+            host, sep, port = options["metrics_listen"].rpartition(":")
+            try:
+                metrics.start_http_server(host, int(port))
+            except (OSError, ValueError) as exc:
+                raise CommandError(
+                    "Invalid metrics address {}: {}".format(
+                        options["metrics_listen"], exc))
+        # Listening threads will open their own connections
+        connections.close_all()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        logger.info("autoreply server listening on %s", options["lmtp"])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+"""
+Metrics exported in the Prometheus text format.
+
+Short-lived processes (the ``autoreply`` command) add their values to
+a textfile read by the node exporter textfile collector, defined by
+the ``AUTOREPLY_METRICS_TEXTFILE`` setting. Cumulated values are kept
+in a state file next to it, updated under an exclusive lock so
+concurrent processes never lose increments.
+
+Long-running processes can also serve metrics over HTTP (see
+``start_http_server``).
+"""
+
+import fcntl
+import http.server
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+    2.5, 5, 10
+)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_sample(name, labels):
+    """Return the sample identifier: name{label="value",...}."""
+    if not labels:
+        return name
+    return "{}{{{}}}".format(name, ",".join(
+        '{}="{}"'.format(
+            key, str(value).replace("\\", r"\\").replace('"', r"\""))
+        for key, value in labels))
+
+
+class Metric(object):
+    """Base class of metrics."""
+
+    mtype = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = registry.lock
+        self.samples = {}
+        registry.register(self)
+
+    def get_labels(self, labels):
+        return tuple(sorted(
+            (key, labels[key]) for key in self.labelnames))
+
+    def reset(self):
+        """Reset values (called with the registry lock held)."""
+        for key in self.samples:
+            self.samples[key] = 0
+
+
+class Counter(Metric):
+    """A value which only increases."""
+
+    mtype = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super(Counter, self).__init__(*args, **kwargs)
+        if not self.labelnames:
+            self.samples[self.name] = 0
+
+    def inc(self, amount=1, **labels):
+        key = format_sample(self.name, self.get_labels(labels))
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    """Distribution of observed values."""
+
+    mtype = "histogram"
+
+    def __init__(self, *args, **kwargs):
+        self.buckets = kwargs.pop("buckets", DEFAULT_BUCKETS)
+        super(Histogram, self).__init__(*args, **kwargs)
+
+    def observe(self, value, **labels):
+        labels = self.get_labels(labels)
+        bucket_name = self.name + "_bucket"
+        keys = [
+            format_sample(bucket_name, labels + (("le", format_value(le)),))
+            for le in self.buckets + (float("inf"),)
+        ]
+        sum_key = format_sample(self.name + "_sum", labels)
+        count_key = format_sample(self.name + "_count", labels)
+        with self.lock:
+            for le, key in zip(self.buckets + (float("inf"),), keys):
+                self.samples[key] = (
+                    self.samples.get(key, 0) + (1 if value <= le else 0))
+            self.samples[sum_key] = self.samples.get(sum_key, 0) + value
+            self.samples[count_key] = self.samples.get(count_key, 0) + 1
+
+
+class Registry(object):
+    """A set of metrics."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def collect(self, reset=False):
+        """Return a {metric name: {sample: value}} dictionary.
+
+        :param bool reset: reset values once collected
+        """
+        with self.lock:
+            result = {
+                metric.name: dict(metric.samples) for metric in self.metrics
+            }
+            if reset:
+                for metric in self.metrics:
+                    metric.reset()
+        return result
+
+    def render(self, state=None):
+        """Render metrics (or a collected state) in text format."""
+        if state is None:
+            state = self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {} {}".format(
+                metric.name, metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.mtype))
+            for sample, value in state.get(metric.name, {}).items():
+                lines.append("{} {}".format(sample, format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+messages_received = Counter(
+    registry, "autoreply_messages_received_total",
+    "Messages received by the autoreply service")
+recipients_skipped = Counter(
+    registry, "autoreply_recipients_skipped_total",
+    "Recipients which didn't trigger a reply, by reason", ["reason"])
+replies_sent = Counter(
+    registry, "autoreply_replies_sent_total",
+    "Autoreply messages sent (or queued)")
+smtp_failures = Counter(
+    registry, "autoreply_smtp_failures_total",
+    "Autoreply messages which could not be sent")
+stage_duration = Histogram(
+    registry, "autoreply_stage_duration_seconds",
+    "Time spent in each stage of the decision pipeline", ["stage"])
+
+
+def write_textfile(path, registry=registry):
+    """Add local values to the textfile and reset them.
+
+    The textfile is replaced atomically.
+    """
+    local = registry.collect(reset=True)
+    with open(path + ".state", "a+") as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        fp.seek(0)
+        content = fp.read()
+        try:
+            state = json.loads(content) if content else {}
+        except ValueError:
+            logger.warning("corrupted metrics state file, starting over")
+            state = {}
+        for name, samples in local.items():
+            cumulated = state.setdefault(name, {})
+            for sample, value in samples.items():
+                cumulated[sample] = cumulated.get(sample, 0) + value
+        fp.seek(0)
+        fp.truncate()
+        json.dump(state, fp)
+        fp.flush()
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path) or ".", prefix=".autoreply")
+        with os.fdopen(fd, "w") as tmp:
+            tmp.write(registry.render(state))
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+
+
+def flush():
+    """Update the textfile if configured. Errors are only logged."""
+    path = getattr(settings, "AUTOREPLY_METRICS_TEXTFILE", None)
+    if not path:
+        return
+    try:
+        write_textfile(path)
+    except OSError:
+        logger.exception("Failed to write metrics to %s", path)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serve metrics on /metrics."""
+
+    def do_GET(self):  # NOQA:N802
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        content = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):  # NOQA:A002
+        pass
+
+
+def start_http_server(address, port, registry=registry):
+    """Serve metrics from a background thread."""
+    server = http.server.ThreadingHTTPServer(
+        (address, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modoboa_postfix_autoreply', '0008_delete_transport'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='arhistoric',
+            name='last_sent',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.16 on 2026-10-18 10:03
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modoboa_postfix_autoreply', '0009_arhistoric_last_sent_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='armessage',
+            name='fromdate',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='armessage',
+            name='untildate',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
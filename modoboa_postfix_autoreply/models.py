@@ -2,7 +2,9 @@
 
 """Postfix autoreply models."""
 
-from django.db import models
+import datetime
+
+from django.db import connections, models, router
 from django.utils import timezone
 from django.utils.encoding import smart_str
 from django.utils.translation import gettext_lazy as _
@@ -12,7 +14,14 @@ from modoboa.admin.models import Mailbox
 
 class ARmessage(models.Model):
 
-    """Auto reply messages."""
+    """Auto reply messages.
+
+    The fields deciding if messages must be routed to the autoreply
+    service are remembered when an instance is loaded, so saving
+    unrelated changes doesn't touch aliases.
+    """
+
+    ROUTING_FIELDS = ("enabled", "fromdate", "untildate")
 
     mbox = models.ForeignKey(Mailbox, on_delete=models.CASCADE)
     subject = models.CharField(
@@ -28,24 +37,136 @@ class ARmessage(models.Model):
         help_text=_("Activate/Deactivate your auto reply"),
         default=False
     )
-    fromdate = models.DateTimeField(default=timezone.now)
-    untildate = models.DateTimeField(null=True, blank=True)
+    fromdate = models.DateTimeField(default=timezone.now, db_index=True)
+    untildate = models.DateTimeField(null=True, blank=True, db_index=True)
 
     class Meta:
         db_table = "postfix_autoreply_armessage"
 
+    def __init__(self, *args, **kwargs):
+        super(ARmessage, self).__init__(*args, **kwargs)
+        self.old_routing_state = self.routing_state
+
     def __str__(self):
         return smart_str("AR<{}>: {}".format(self.mbox, self.enabled))
 
+    @property
+    def routing_state(self):
+        """Values of the fields deciding if messages are routed."""
+        # Deferred fields are not loaded
+        return tuple(self.__dict__.get(name) for name in self.ROUTING_FIELDS)
+
+    def routing_changed(self):
+        """Tell if the routing state changed since last load or save."""
+        return self.old_routing_state != self.routing_state
+
+    def is_active(self, now=None):
+        """Tell if this message must be sent at the given date."""
+        if not self.enabled:
+            return False
+        if now is None:
+            now = timezone.now()
+        if self.fromdate > now:
+            return False
+        return self.untildate is None or self.untildate > now
+
+
+class ARhistoricManager(models.Manager):
+
+    """Custom manager for ARhistoric."""
+
+    UPSERT_SQL = (
+        "INSERT INTO {table} ({armessage}, {sender}, {last_sent}) "
+        "VALUES (%s, %s, %s) "
+        "ON CONFLICT ({armessage}, {sender}) "
+        "DO UPDATE SET {last_sent} = EXCLUDED.{last_sent} "
+        "WHERE {table}.{last_sent} < %s"
+    )
+
+    def _upsert(self, connection, armessage, sender, now, threshold):
+        """Claim a slot using a single INSERT ... ON CONFLICT statement."""
+        opts = self.model._meta
+        qn = connection.ops.quote_name
+        sql = self.UPSERT_SQL.format(
+            table=qn(opts.db_table),
+            armessage=qn(opts.get_field("armessage").column),
+            sender=qn(opts.get_field("sender").column),
+            last_sent=qn(opts.get_field("last_sent").column)
+        )
+        params = [
+            armessage.pk, sender,
+            connection.ops.adapt_datetimefield_value(now),
+            connection.ops.adapt_datetimefield_value(threshold)
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount == 1
+
+    def claim(self, armessage, sender, timeout):
+        """Reserve the right to send a reply to sender.
+
+        The decision and the reservation are made atomically so
+        concurrent deliveries can't send the same reply twice.
+
+        :param armessage: ``ARmessage`` instance
+        :param str sender: address the reply will be sent to
+        :param int timeout: minimum delay (in seconds) between two replies
+        :return: the reservation date if the reply can be sent, else None
+        """
+        now = timezone.now()
+        threshold = now - datetime.timedelta(seconds=timeout)
+        db = router.db_for_write(self.model)
+        connection = connections[db]
+        if connection.vendor in ("postgresql", "sqlite"):
+            claimed = self._upsert(
+                connection, armessage, sender, now, threshold)
+        else:
+            # MySQL & co: conditional UPDATE, then INSERT relying on
+            # the unique constraint.
+            qset = self.using(db).filter(
+                armessage=armessage, sender=sender, last_sent__lt=threshold)
+            claimed = bool(qset.update(last_sent=now))
+            if not claimed:
+                obj, claimed = self.using(db).get_or_create(
+                    armessage=armessage, sender=sender,
+                    defaults={"last_sent": now})
+                now = obj.last_sent
+        return now if claimed else None
+
+    def release(self, armessage, sender, claimed):
+        """Cancel a reservation made with :meth:`claim`."""
+        self.filter(
+            armessage=armessage, sender=sender, last_sent=claimed).delete()
+
+    def throttled(self, pairs, timeout):
+        """Find which (armessage, sender) pairs got a reply recently.
+
+        A single query is used for all pairs.
+
+        :param list pairs: list of (armessage id, sender) tuples
+        :return: the set of throttled pairs
+        """
+        if not pairs:
+            return set()
+        threshold = timezone.now() - datetime.timedelta(seconds=timeout)
+        qset = self.filter(
+            armessage__in={pk for pk, sender in pairs},
+            sender__in={sender for pk, sender in pairs},
+            last_sent__gte=threshold
+        ).values_list("armessage_id", "sender")
+        return set(qset) & set(pairs)
+
 
 class ARhistoric(models.Model):
 
     """Auto reply historic."""
 
     armessage = models.ForeignKey(ARmessage, on_delete=models.CASCADE)
-    last_sent = models.DateTimeField(auto_now=True)
+    last_sent = models.DateTimeField(auto_now=True, db_index=True)
     sender = models.CharField(max_length=254)
 
+    objects = ARhistoricManager()
+
     class Meta:
         unique_together = ("armessage", "sender")
         db_table = "postfix_autoreply_arhistoric"
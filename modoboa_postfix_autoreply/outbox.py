@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""
+Queue of autoreply messages waiting to be sent.
+
+When the ``AUTOREPLY_OUTBOX_DIR`` setting is defined, replies are
+written into this spool directory instead of being sent immediately:
+the delivery agent never waits for the SMTP server. The
+``autoreply_outbox`` command sends queued messages, retrying failed
+deliveries with an exponential backoff.
+"""
+
+import email
+import functools
+import logging
+import smtplib
+
+from django.conf import settings
+from django.core import mail
+from django.core.mail import EmailMessage
+
+from . import smtp, spool
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_BACKOFF = 60
+MAX_BACKOFF = 3600 * 6
+
+
+class SpooledMessage(EmailMessage):
+    """An already rendered message read from the outbox."""
+
+    def __init__(self, from_email, to, raw):
+        super(SpooledMessage, self).__init__(from_email=from_email, to=to)
+        self.raw = raw
+
+    def message(self):
+        return email.message_from_bytes(self.raw)
+
+
+@functools.lru_cache(maxsize=None)
+def get_outbox():
+    """Return the outbox spool or None if it is not configured."""
+    path = getattr(settings, "AUTOREPLY_OUTBOX_DIR", None)
+    if not path:
+        return None
+    return spool.Spool(path)
+
+
+def serialize(msg):
+    """Serialize an EmailMessage (envelope first, then content)."""
+    return spool.pack(
+        {"from": msg.from_email, "to": msg.recipients()},
+        msg.message().as_bytes(linesep="\r\n"))
+
+
+def deserialize(data):
+    """Rebuild a message from serialize() output."""
+    envelope, raw = spool.unpack(data)
+    return SpooledMessage(envelope["from"], envelope["to"], raw)
+
+
+def enqueue(outbox, msg):
+    """Add a message to the outbox."""
+    name = outbox.put(serialize(msg))
+    logger.debug("autoreply message queued (%s)", name)
+    return name
+
+
+def get_retry_delay(attempts, backoff=DEFAULT_BACKOFF):
+    """Return the delay before the next attempt (exponential backoff)."""
+    return min(backoff * 2 ** attempts, MAX_BACKOFF)
+
+
+def flush(outbox, batch_size=100, max_attempts=DEFAULT_MAX_ATTEMPTS,
+          backoff=DEFAULT_BACKOFF, connection=None):
+    """Send queued messages which are ready, using a single connection.
+
+    :return: a (sent, deferred, failed) tuple
+    """
+    sent = deferred = failed = 0
+    entries = outbox.claim(batch_size)
+    if not entries:
+        return sent, deferred, failed
+    own_connection = connection is None
+    if own_connection:
+        connection = mail.get_connection()
+    try:
+        for pos, entry in enumerate(entries):
+            try:
+                smtp.send_message(deserialize(entry.read()), connection)
+            except (smtplib.SMTPException, OSError) as exc:
+                permanent = (
+                    isinstance(exc, smtplib.SMTPResponseException) and
+                    exc.smtp_code >= 500)
+                if permanent or entry.attempts + 1 >= max_attempts:
+                    logger.error(
+                        "giving up autoreply message %s after %d attempts: "
+                        "%s", entry.name, entry.attempts + 1, exc)
+                    outbox.fail(entry)
+                    failed += 1
+                    continue
+                logger.warning(
+                    "failed to send autoreply message %s: %s", entry.name,
+                    exc)
+                delay = get_retry_delay(entry.attempts, backoff)
+                outbox.retry(entry, delay)
+                deferred += 1
+                if not isinstance(exc, smtplib.SMTPRecipientsRefused):
+                    # The server is probably unavailable, don't insist
+                    for other in entries[pos + 1:]:
+                        outbox.retry(other, delay, count=False)
+                        deferred += 1
+                    break
+                continue
+            except ValueError as exc:
+                logger.error(
+                    "invalid autoreply message %s: %s", entry.name, exc)
+                outbox.fail(entry)
+                failed += 1
+                continue
+            outbox.complete(entry)
+            sent += 1
+    finally:
+        if own_connection:
+            connection.close()
+    return sent, deferred, failed
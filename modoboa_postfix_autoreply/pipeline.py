@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+
+"""
+Autoreply decision pipeline.
+
+Stages are ordered from the cheapest to the most expensive one, so
+most messages are rejected before the message itself is read:
+
+1. ``sender``: mailing lists and robots (sender localpart)
+2. ``recipient``: recipients with an enabled auto-reply message
+3. ``window``: auto-reply messages currently active
+4. ``throttle``: last reply sent to this sender (read only)
+5. ``headers``: mailing list and bulk messages (message headers)
+6. ``claim``: reserve the right to reply to this sender
+7. ``render``: build the replies
+8. ``send``: send (or queue) the replies
+
+Each stage records the number of messages it rejected and the time
+spent in it. Outcomes are also exported as metrics (see ``metrics``).
+
+When a message has several recipients, replies can be sent
+concurrently by a bounded number of threads, each one using its own
+SMTP connection. Database accesses stay in the calling thread.
+"""
+
+import logging
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core import mail
+from django.utils import timezone
+
+from . import lib, metrics, outbox, throttle
+
+logger = logging.getLogger(__name__)
+
+STAGES = [
+    "sender", "recipient", "window", "throttle", "headers", "claim",
+    "render", "send"
+]
+
+
+class PipelineStats(object):
+    """Per-stage counters, shared by all pipelines of the process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = dict.fromkeys(STAGES, 0)
+            self.rejected = dict.fromkeys(STAGES, 0)
+            self.seconds = dict.fromkeys(STAGES, 0.0)
+
+    def record(self, stage, elapsed, rejected=False):
+        with self.lock:
+            self.calls[stage] += 1
+            self.seconds[stage] += elapsed
+            if rejected:
+                self.rejected[stage] += 1
+
+    def snapshot(self):
+        """Return a {stage: (calls, rejected, seconds)} dictionary."""
+        with self.lock:
+            return {
+                stage: (
+                    self.calls[stage], self.rejected[stage],
+                    self.seconds[stage])
+                for stage in STAGES
+            }
+
+
+stats = PipelineStats()
+
+
+class Candidate(object):
+    """A recipient which may receive a reply."""
+
+    def __init__(self, recipient, armessage):
+        self.recipient = recipient
+        self.armessage = armessage
+        self.claimed = None
+        self.message = None
+
+
+class Pipeline(object):
+    """Decide which replies to send for a message, then send them.
+
+    :param str sender: envelope sender
+    :param list recipients: local recipients (full addresses)
+    :param get_original_msg: callable returning the original message
+                             headers, only called if needed
+    :param int timeout: autoreplies timeout (fetched if not provided)
+    :param int concurrency: maximum number of replies sent at the same
+                            time (only when no connection is provided)
+    :param dict armessages: prefetched auto-reply messages (recipient ->
+                            ARmessage), see ``lib.get_armessages``
+    :param set throttled: (ARmessage id, sender) pairs known to be
+                          throttled (see ``prefetch`` of throttle
+                          backends), fetched if not provided
+    """
+
+    def __init__(self, sender, recipients, get_original_msg, timeout=None,
+                 concurrency=1, armessages=None, throttled=None):
+        self.sender = sender
+        self.recipients = recipients
+        self.get_original_msg = get_original_msg
+        self.original_msg = None
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.armessages = armessages
+        self.throttled = throttled
+        self.backend = throttle.get_backend()
+        self.now = timezone.now()
+        self.connection = None
+        self.failures = {}
+        self.claimed = []
+        self.timings = []
+        self.rejected_by = None
+
+    def run_stage(self, name, candidates):
+        """Run a stage and record its statistics."""
+        start = time.monotonic()
+        try:
+            candidates = getattr(self, "stage_{}".format(name))(candidates)
+        finally:
+            elapsed = time.monotonic() - start
+            self.timings.append((name, elapsed))
+            stats.record(name, elapsed, rejected=not candidates)
+            metrics.stage_duration.observe(elapsed, stage=name)
+        if not candidates:
+            self.rejected_by = name
+            logger.debug("autoreply rejected by stage %s", name)
+        return candidates
+
+    def log_timings(self):
+        logger.debug("autoreply pipeline timings: %s", ", ".join(
+            "{}={:.3f}ms".format(name, elapsed * 1000)
+            for name, elapsed in self.timings))
+
+    def skip(self, reason, count=1):
+        if count:
+            metrics.recipients_skipped.inc(count, reason=reason)
+
+    def decide(self):
+        """Run all stages but the last one.
+
+        :return: the list of candidates which will receive a reply
+        """
+        metrics.messages_received.inc()
+        candidates = self.recipients
+        for name in STAGES[:-1]:
+            candidates = self.run_stage(name, candidates)
+            if not candidates:
+                self.log_timings()
+                return []
+        return candidates
+
+    def send(self, candidates, connection=None):
+        """Run the last stage.
+
+        :param connection: email backend instance to reuse. If not
+                           provided, replies can be sent concurrently
+        :return: a dictionary (recipient -> exception) of failures
+        """
+        self.connection = connection
+        self.run_stage("send", candidates)
+        self.log_timings()
+        return self.failures
+
+    def run(self):
+        """Run the whole pipeline using a single connection.
+
+        :return: a dictionary (recipient -> exception) of failures
+        """
+        try:
+            candidates = self.decide()
+            if not candidates:
+                return {}
+            if self.get_workers(candidates) > 1:
+                # Each worker uses its own connection
+                return self.send(candidates)
+            connection = mail.get_connection()
+            try:
+                return self.send(candidates, connection)
+            finally:
+                connection.close()
+        except BaseException:
+            # Let a retry of this message send the replies (deadline
+            # exceeded for example)
+            self.release_quietly(self.claimed)
+            raise
+
+    def release(self, candidates):
+        """Cancel the reservations made by the throttle stage."""
+        for candidate in candidates:
+            if candidate.claimed is not None:
+                self.backend.release(
+                    candidate.armessage, self.sender, candidate.claimed)
+                candidate.claimed = None
+
+    def release_quietly(self, candidates):
+        """Like release() but only log errors."""
+        try:
+            self.release(candidates)
+        except Exception:
+            logger.exception("Failed to release autoreply reservations")
+
+    def fail(self, candidate, exc):
+        """Register a failure and cancel the candidate's reservation."""
+        self.release([candidate])
+        self.failures[candidate.recipient] = exc
+
+    def stage_sender(self, recipients):
+        if lib.is_mailing_list_sender(self.sender):
+            self.skip("mailing_list", len(recipients))
+            return []
+        return recipients
+
+    def stage_recipient(self, recipients):
+        armessages = self.armessages
+        if armessages is None:
+            armessages = lib.get_armessages(recipients)
+        else:
+            armessages = {
+                rcpt: armessages[rcpt] for rcpt in recipients
+                if rcpt in armessages
+            }
+        # Unknown recipients and recipients without (enabled) message
+        # can't be told apart without another query
+        self.skip("no_autoreply", len(recipients) - len(armessages))
+        return [
+            Candidate(fulladdress, armessages[fulladdress])
+            for fulladdress in recipients if fulladdress in armessages
+        ]
+
+    def stage_window(self, candidates):
+        result = []
+        for candidate in candidates:
+            armessage = candidate.armessage
+            too_soon = armessage.fromdate > self.now
+            if not lib.check_activation_window(armessage, self.now):
+                self.skip("too_soon" if too_soon else "expired")
+                continue
+            result.append(candidate)
+        return result
+
+    def stage_throttle(self, candidates):
+        if self.timeout is None:
+            self.timeout = lib.get_autoreplies_timeout()
+        if self.throttled is None:
+            self.throttled = self.backend.prefetch([
+                (candidate.armessage.pk, self.sender)
+                for candidate in candidates
+            ], self.timeout)
+        result = []
+        for candidate in candidates:
+            if (candidate.armessage.pk, self.sender) in self.throttled:
+                self.skip("throttled")
+                logger.debug(
+                    "no autoreply message sent because timeout (%s) "
+                    "is not over", self.timeout)
+                continue
+            result.append(candidate)
+        return result
+
+    def stage_headers(self, candidates):
+        self.original_msg = self.get_original_msg()
+        if lib.is_mailing_list_message(self.original_msg):
+            self.skip("bulk_message", len(candidates))
+            return []
+        return candidates
+
+    def stage_claim(self, candidates):
+        result = []
+        try:
+            for candidate in candidates:
+                candidate.claimed = self.backend.claim(
+                    candidate.armessage, self.sender, self.timeout)
+                if candidate.claimed is None:
+                    self.skip("throttled")
+                    logger.debug(
+                        "no autoreply message sent because timeout (%s) "
+                        "is not over", self.timeout)
+                    continue
+                result.append(candidate)
+        except BaseException:
+            self.release_quietly(result)
+            raise
+        self.claimed = result
+        return result
+
+    def stage_render(self, candidates):
+        result = []
+        for candidate in candidates:
+            try:
+                candidate.message = lib.build_autoreply(
+                    self.sender, candidate.armessage.mbox,
+                    candidate.armessage, self.original_msg)
+            except Exception as exc:
+                logger.exception("Failed to build autoreply message")
+                self.fail(candidate, exc)
+                continue
+            result.append(candidate)
+        return result
+
+    def get_workers(self, candidates):
+        """Return the number of threads to use to send replies."""
+        if self.connection is not None or outbox.get_outbox() is not None:
+            return 1
+        return max(1, min(self.concurrency, len(candidates)))
+
+    @staticmethod
+    def deliver(candidate, connection):
+        """Send a reply, return the exception raised (if any).
+
+        The reservation of a sent reply is kept even if the pipeline is
+        interrupted later (only unsent replies are released).
+        """
+        try:
+            lib.deliver(candidate.message, connection)
+        except Exception as exc:
+            return exc
+        candidate.claimed = None
+        return None
+
+    def deliver_concurrently(self, candidates, workers):
+        """Send replies from a pool of threads.
+
+        :return: the list of exceptions raised (or None) per candidate
+        """
+        local = threading.local()
+        opened = []
+        lock = threading.Lock()
+
+        def task(candidate):
+            connection = getattr(local, "connection", None)
+            if connection is None:
+                connection = local.connection = mail.get_connection()
+                with lock:
+                    opened.append(connection)
+            return self.deliver(candidate, connection)
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(task, candidates))
+        finally:
+            for connection in opened:
+                connection.close()
+
+    def stage_send(self, candidates):
+        workers = self.get_workers(candidates)
+        if workers > 1:
+            errors = self.deliver_concurrently(candidates, workers)
+        else:
+            errors = [
+                self.deliver(candidate, self.connection)
+                for candidate in candidates
+            ]
+        result = []
+        for candidate, exc in zip(candidates, errors):
+            if exc is not None:
+                if isinstance(exc, smtplib.SMTPException):
+                    logger.error("Failed to send autoreply message: %s", exc)
+                else:
+                    logger.error(
+                        "Failed to send autoreply message", exc_info=exc)
+                metrics.smtp_failures.inc()
+                self.fail(candidate, exc)
+                continue
+            metrics.replies_sent.inc()
+            logger.debug(
+                "autoreply message sent to %s",
+                candidate.armessage.mbox.user.encoded_address)
+            result.append(candidate)
+        return result
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""Sampled profiling of autoreply invocations."""
+
+import contextlib
+import cProfile
+import datetime
+import glob
+import logging
+import os
+import pstats
+import random
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def get_profile_settings(directory=None, sample_rate=None):
+    """Return the (directory, sample rate) to use.
+
+    Command line values take precedence over the
+    ``AUTOREPLY_PROFILE_DIR`` and ``AUTOREPLY_PROFILE_SAMPLE_RATE``
+    settings.
+    """
+    if directory is None:
+        directory = getattr(settings, "AUTOREPLY_PROFILE_DIR", None)
+    if sample_rate is None:
+        sample_rate = getattr(settings, "AUTOREPLY_PROFILE_SAMPLE_RATE", 1)
+    return directory, sample_rate
+
+
+def get_profile_path(directory):
+    """Return a unique file name (timestamp and pid)."""
+    return os.path.join(directory, "{}-{}.pstats".format(
+        datetime.datetime.now().strftime("%Y%m%dT%H%M%S.%f"), os.getpid()))
+
+
+@contextlib.contextmanager
+def sampled_profile(directory, sample_rate):
+    """Profile the enclosed code for a fraction of calls.
+
+    Profiles are written even if the code raises an exception
+    (including SystemExit).
+    """
+    if not directory or random.random() >= sample_rate:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        path = get_profile_path(directory)
+        try:
+            profiler.dump_stats(path)
+        except OSError:
+            logger.exception("Failed to write profile %s", path)
+
+
+def load_profiles(directory):
+    """Merge all profiles found in directory.
+
+    :return: a ``pstats.Stats`` instance (or None) and the number of
+             profiles
+    """
+    stats = None
+    count = 0
+    for path in sorted(glob.glob(os.path.join(directory, "*.pstats"))):
+        try:
+            if stats is None:
+                stats = pstats.Stats(path)
+            else:
+                stats.add(path)
+        except (OSError, EOFError, TypeError, ValueError):
+            logger.warning("Ignoring invalid profile %s", path)
+            continue
+        count += 1
+    return stats, count
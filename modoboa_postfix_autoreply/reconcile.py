@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""Make routing aliases match active auto-reply messages.
+
+Differences are computed by the database (anti-joins), in both
+directions:
+
+* routing aliases without an active auto-reply message are removed,
+* active auto-reply messages without routing alias get one.
+
+Changes are applied by chunks, one transaction per chunk.
+"""
+
+import logging
+
+from django.db import transaction
+from django.db.models import CharField, Exists, OuterRef, Q, Value
+from django.db.models.functions import Concat
+from django.utils import timezone
+
+from modoboa.admin import models as admin_models
+
+from . import routing
+from .bulk import CHUNK_SIZE, chunks
+from .models import ARmessage
+
+logger = logging.getLogger(__name__)
+
+
+def get_active_armessages(now):
+    """Return auto-reply messages which must be routed at now."""
+    return (
+        ARmessage.objects.filter(enabled=True, fromdate__lte=now)
+        .filter(Q(untildate__isnull=True) | Q(untildate__gt=now))
+    )
+
+
+def get_stale_recipients(now):
+    """Return routing alias recipients without active message."""
+    active = get_active_armessages(now).annotate(
+        full_address=Concat(
+            "mbox__address", Value("@"), "mbox__domain__name",
+            output_field=CharField())
+    ).filter(
+        mbox__domain=OuterRef("alias__domain"),
+        full_address=OuterRef("alias__address"))
+    return routing.get_all_routing_recipients().filter(~Exists(active))
+
+
+def get_unrouted_armessages(now):
+    """Return active auto-reply messages without routing alias."""
+    routed = routing.get_all_routing_recipients().filter(
+        alias__domain=OuterRef("mbox__domain"),
+        alias__address=Concat(
+            OuterRef("mbox__address"), Value("@"),
+            OuterRef("mbox__domain__name"), output_field=CharField()))
+    return get_active_armessages(now).filter(~Exists(routed))
+
+
+def add_recipients(rows, dry_run, report):
+    """Create routing alias recipients for (mailbox id, address) rows."""
+    addresses = [address for mbox_id, address in rows]
+    aliases = {
+        alias.address: alias
+        for alias in admin_models.Alias.objects.filter(
+            internal=True, address__in=addresses)
+    }
+    new = []
+    for mbox_id, address in rows:
+        report("add", routing.get_routing_address_of(address))
+        if dry_run:
+            continue
+        alias = aliases.get(address)
+        if alias is None:
+            # Should not happen, let the usual code create the alias
+            routing.add_routing_alias(
+                admin_models.Mailbox.objects.select_related("domain")
+                .get(pk=mbox_id))
+            continue
+        new.append(admin_models.AliasRecipient(
+            alias=alias, address=routing.get_routing_address_of(address)))
+    admin_models.AliasRecipient.objects.bulk_create(new)
+
+
+def reconcile(now=None, dry_run=False, chunk_size=CHUNK_SIZE, report=None):
+    """Add missing and remove stale routing aliases.
+
+    :param bool dry_run: only report differences
+    :param report: callable receiving ("add" or "remove", address) for
+                   each difference
+    :return: a (added, removed) tuple
+    """
+    if now is None:
+        now = timezone.now()
+    if report is None:
+        def report(action, address):
+            logger.debug("%s %s", action, address)
+    stale = list(
+        get_stale_recipients(now).order_by("pk")
+        .values_list("pk", "address"))
+    for rows in chunks(stale, chunk_size):
+        for pk, address in rows:
+            report("remove", address)
+        if not dry_run:
+            admin_models.AliasRecipient.objects.filter(
+                pk__in=[pk for pk, address in rows]).delete()
+    missing = list(
+        get_unrouted_armessages(now).order_by("mbox")
+        .annotate(full_address=Concat(
+            "mbox__address", Value("@"), "mbox__domain__name",
+            output_field=CharField()))
+        .values_list("mbox", "full_address").distinct())
+    for rows in chunks(missing, chunk_size):
+        with transaction.atomic():
+            add_recipients(rows, dry_run, report)
+    return len(missing), len(stale)
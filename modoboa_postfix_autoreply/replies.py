@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+"""Precompiled autoreply messages.
+
+Everything that doesn't depend on the sender (rendered content, encoded
+body, From header, ...) is computed once per message version and
+language, then kept in a bounded in-process cache.
+"""
+
+import collections
+import copy
+import hashlib
+import threading
+from email.utils import formatdate, make_msgid
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.core.mail.message import SafeMIMEText
+from django.core.mail.utils import DNS_NAME
+from django.utils import translation
+from django.utils.encoding import smart_str
+from django.utils.formats import localize
+
+MAX_TEMPLATES = 1024
+
+FIXED_HEADERS = {
+    "Auto-Submitted": "auto-replied",
+    "Precedence": "bulk"
+}
+
+
+class ReplyTemplate(object):
+    """Sender independent part of an autoreply message."""
+
+    def __init__(self, mailbox, armessage):
+        self.user_id = mailbox.user_id
+        self.subject_prefix = "Auto: {} Re: ".format(armessage.subject)
+        self.from_email = mailbox.user.encoded_address
+        with translation.override(mailbox.user.language):
+            context = {
+                "name": mailbox.user.fullname,
+                "fromdate": localize(armessage.fromdate),
+                "untildate": ""
+            }
+            if armessage.untildate:
+                context.update({"untildate": localize(armessage.untildate)})
+        self.body = smart_str(armessage.content % context)
+        self.mime = SafeMIMEText(
+            self.body, "plain", settings.DEFAULT_CHARSET)
+        self.mime["From"] = self.from_email
+        for name, value in FIXED_HEADERS.items():
+            self.mime[name] = value
+
+
+class AutoreplyMessage(EmailMessage):
+    """An EmailMessage built from a ReplyTemplate."""
+
+    def __init__(self, template, subject, to, headers=None):
+        super(AutoreplyMessage, self).__init__(
+            template.subject_prefix + subject, template.body,
+            template.from_email, to, headers=headers)
+        self.template = template
+
+    def message(self):
+        msg = copy.deepcopy(self.template.mime)
+        msg["Subject"] = self.subject
+        msg["To"] = ", ".join(str(v) for v in self.to)
+        msg["Date"] = formatdate(localtime=settings.EMAIL_USE_LOCALTIME)
+        msg["Message-ID"] = make_msgid(domain=DNS_NAME)
+        for name, value in self.extra_headers.items():
+            msg[name] = value
+        return msg
+
+
+class ReplyTemplateCache(object):
+    """Bounded LRU cache of reply templates."""
+
+    def __init__(self, max_entries=MAX_TEMPLATES):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(mailbox, armessage):
+        """Build a key changing with every rendering input.
+
+        This way, stale entries are never used even when the
+        modification happened in another process.
+        """
+        user = mailbox.user
+        version = hashlib.sha1("\0".join(str(value) for value in [
+            armessage.subject, armessage.content, armessage.fromdate,
+            armessage.untildate, user.first_name, user.last_name,
+            user.username, user.email
+        ]).encode("utf-8")).hexdigest()
+        return (armessage.pk, version, user.language)
+
+    def get(self, mailbox, armessage):
+        """Return the template to use for armessage."""
+        key = self.get_key(mailbox, armessage)
+        with self.lock:
+            template = self.entries.get(key)
+            if template is not None:
+                self.entries.move_to_end(key)
+                return template
+        template = ReplyTemplate(mailbox, armessage)
+        with self.lock:
+            self.entries[key] = template
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return template
+
+    def invalidate(self, armessage_id=None, user_id=None):
+        """Drop entries related to an ARmessage or a user."""
+        with self.lock:
+            for key in list(self.entries):
+                if key[0] == armessage_id or \
+                        self.entries[key].user_id == user_id:
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+templates = ReplyTemplateCache()
+
+
+def build_autoreply(sender, mailbox, armessage, subject, message_id=None):
+    """Build the autoreply message to send to sender.
+
+    :param str subject: subject of the original message
+    :param str message_id: Message-ID of the original message
+    """
+    headers = {}
+    if message_id:
+        headers.update({"In-Reply-To": message_id, "References": message_id})
+    return AutoreplyMessage(
+        templates.get(mailbox, armessage), subject, [sender], headers)
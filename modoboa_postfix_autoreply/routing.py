@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""Management of the aliases routing messages to the autoreply service.
+
+Routing aliases are recipients of the internal alias of a mailbox.
+Lookups always go through the internal alias (indexed address) and
+compare the exact computed routing address, never pattern matching on
+the whole alias recipient table.
+"""
+
+import logging
+
+from django.db import transaction
+from django.db.models import CharField, F, Value
+from django.db.models.functions import Concat, Replace
+
+from modoboa.admin import models as admin_models
+
+logger = logging.getLogger(__name__)
+
+
+def get_routing_address(mbox):
+    """Return the routing address of a mailbox."""
+    return "{}@autoreply.{}".format(mbox.full_address, mbox.domain)
+
+
+def get_routing_address_of(full_address):
+    """Return the routing address of a mailbox full address."""
+    return "{}@autoreply.{}".format(full_address, full_address.split("@")[1])
+
+
+def get_routing_recipients(full_addresses):
+    """Return routing alias recipients of some mailbox addresses.
+
+    :param list full_addresses: mailbox full addresses
+    """
+    return admin_models.AliasRecipient.objects.filter(
+        alias__address__in=full_addresses, alias__internal=True,
+        address__in=[
+            get_routing_address_of(address) for address in full_addresses
+        ])
+
+
+def get_all_routing_recipients():
+    """Return all routing alias recipients.
+
+    The routing address is computed from the alias address and its
+    domain, so recipients are found with a join instead of a pattern.
+    """
+    return admin_models.AliasRecipient.objects.filter(
+        alias__internal=True,
+        address=Concat(
+            F("alias__address"), Value("@autoreply."),
+            F("alias__domain__name"), output_field=CharField()))
+
+
+def rename_mailbox(old_address, mbox):
+    """Update the routing address of a renamed mailbox.
+
+    The internal alias may have been renamed already or not.
+    """
+    return admin_models.AliasRecipient.objects.filter(
+        alias__address__in=[old_address, mbox.full_address],
+        alias__internal=True,
+        address=get_routing_address_of(old_address)
+    ).update(address=get_routing_address(mbox))
+
+
+def get_routing_suffix(domain_name):
+    """Return the end of routing addresses of a domain's mailboxes."""
+    return "@{0}@autoreply.{0}".format(domain_name)
+
+
+def get_domain_routing_recipients(domain, name):
+    """Return routing alias recipients of a domain.
+
+    :param domain: ``Domain`` instance
+    :param str name: domain name used in routing addresses
+    """
+    return admin_models.AliasRecipient.objects.filter(
+        alias__domain=domain, alias__internal=True,
+        address__endswith=get_routing_suffix(name))
+
+
+def rename_domain(domain, oldname, chunk_size=None, progress=None):
+    """Update routing addresses after a domain rename.
+
+    Addresses are rewritten by the database. Only their domain part is
+    replaced, so a local part containing the old name is left alone.
+    With chunk_size, rows are updated by chunks (one transaction per
+    chunk), so an interrupted rename can be resumed.
+
+    :param progress: callable receiving (done, total) after each chunk
+    :return: number of updated addresses
+    """
+    qset = get_domain_routing_recipients(domain, oldname)
+    new_address = Replace(
+        F("address"), Value(get_routing_suffix(oldname)),
+        Value(get_routing_suffix(domain.name)))
+    if chunk_size is None:
+        return qset.update(address=new_address)
+    total = qset.count()
+    done = 0
+    while True:
+        # Updated rows don't match anymore
+        pks = list(qset.values_list("pk", flat=True)[:chunk_size])
+        if not pks:
+            return done
+        with transaction.atomic():
+            done += admin_models.AliasRecipient.objects.filter(
+                pk__in=pks).update(address=new_address)
+        if progress is not None:
+            progress(done, total)
+
+
+def add_routing_alias(mbox):
+    """Route messages sent to mbox to the autoreply service."""
+    alias, created = admin_models.Alias.objects.get_or_create(
+        address=mbox.full_address, domain=mbox.domain, internal=True)
+    admin_models.AliasRecipient.objects.get_or_create(
+        alias=alias, address=get_routing_address(mbox))
+
+
+def remove_routing_alias(mbox):
+    """Stop routing messages sent to mbox to the autoreply service."""
+    get_routing_recipients([mbox.full_address]).delete()
+
+
+def update_routing_alias(armessage, now=None):
+    """Add or remove the routing alias according to armessage's state."""
+    if armessage.is_active(now):
+        add_routing_alias(armessage.mbox)
+    else:
+        remove_routing_alias(armessage.mbox)
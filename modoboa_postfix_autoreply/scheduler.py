@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""Activate and expire auto-reply messages at the right time.
+
+Routing aliases only exist for messages which are active right now, so
+Postfix doesn't call the autoreply service for the others.
+"""
+
+import logging
+
+from django.db.models import Q
+from django.utils import timezone
+
+from . import routing
+from .models import ARmessage
+
+logger = logging.getLogger(__name__)
+
+
+def apply_transitions(now=None, since=None):
+    """Apply activations and expirations which occurred before now.
+
+    :param datetime now: reference date (default: current date)
+    :param datetime since: only look for messages activated after this
+                           date (default: all active messages)
+    :return: a tuple (activated, expired)
+    """
+    if now is None:
+        now = timezone.now()
+    qset = ARmessage.objects.select_related("mbox__domain")
+    expired = 0
+    for armessage in qset.filter(enabled=True, untildate__lte=now):
+        logger.debug("%s has expired", armessage)
+        # post_save handler removes the routing alias
+        armessage.enabled = False
+        armessage.save(update_fields=["enabled"])
+        expired += 1
+    activated = 0
+    qset = (
+        qset.filter(enabled=True, fromdate__lte=now)
+        .filter(Q(untildate__isnull=True) | Q(untildate__gt=now))
+    )
+    if since is not None:
+        qset = qset.filter(fromdate__gt=since)
+    for armessage in qset:
+        logger.debug("%s is active", armessage)
+        routing.add_routing_alias(armessage.mbox)
+        activated += 1
+    return activated, expired
+
+
+def next_transition(now=None):
+    """Return the date of the next activation or expiration (or None)."""
+    if now is None:
+        now = timezone.now()
+    qset = ARmessage.objects.filter(enabled=True)
+    dates = [
+        qset.filter(fromdate__gt=now).order_by("fromdate")
+        .values_list("fromdate", flat=True).first(),
+        qset.filter(untildate__gt=now).order_by("untildate")
+        .values_list("untildate", flat=True).first()
+    ]
+    dates = [date for date in dates if date is not None]
+    return min(dates) if dates else None
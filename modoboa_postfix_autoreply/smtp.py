@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+"""Reuse of outgoing SMTP connections."""
+
+import contextlib
+import logging
+import smtplib
+import threading
+import time
+
+from django.core import mail
+
+logger = logging.getLogger(__name__)
+
+
+def send_message(msg, connection):
+    """Send msg using an already opened connection.
+
+    If the server closed the connection in the meantime, it is
+    reopened and the message sent again (once).
+    """
+    msg.connection = connection
+    connection.open()
+    try:
+        return msg.send()
+    except smtplib.SMTPServerDisconnected:
+        logger.debug("SMTP connection lost, reconnecting")
+        connection.close()
+        connection.open()
+        return msg.send()
+
+
+def is_alive(connection):
+    """Check if a connection is still usable (NOOP)."""
+    smtp = getattr(connection, "connection", None)
+    if smtp is None:
+        # Not opened yet or not a SMTP backend
+        return True
+    try:
+        return smtp.noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+        return False
+
+
+class ConnectionPool(object):
+    """A bounded pool of email backend connections.
+
+    Idle connections are closed after ``idle_timeout`` seconds and
+    checked (NOOP) before being reused.
+    """
+
+    def __init__(self, max_size=4, idle_timeout=60):
+        self.idle_timeout = idle_timeout
+        self.semaphore = threading.BoundedSemaphore(max_size)
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Return an opened connection."""
+        self.semaphore.acquire()
+        try:
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    connection, last_used = self.idle.pop()
+                expired = time.monotonic() - last_used > self.idle_timeout
+                if not expired and is_alive(connection):
+                    return connection
+                connection.close()
+            connection = mail.get_connection()
+            connection.open()
+            return connection
+        except Exception:
+            self.semaphore.release()
+            raise
+
+    def release(self, connection, broken=False):
+        """Give a connection back to the pool."""
+        if broken:
+            connection.close()
+        else:
+            with self.lock:
+                self.idle.append((connection, time.monotonic()))
+        self.semaphore.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Context manager around acquire() and release()."""
+        connection = self.acquire()
+        try:
+            yield connection
+        except (smtplib.SMTPException, OSError):
+            self.release(connection, broken=True)
+            raise
+        except BaseException:
+            self.release(connection)
+            raise
+        self.release(connection)
+
+    def close_idle(self):
+        """Close idle connections which reached the timeout."""
+        now = time.monotonic()
+        with self.lock:
+            expired = [
+                item for item in self.idle
+                if now - item[1] > self.idle_timeout]
+            self.idle = [item for item in self.idle if item not in expired]
+        for connection, last_used in expired:
+            connection.close()
+
+    def close_all(self):
+        """Close all idle connections."""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection, last_used in idle:
+            connection.close()
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+"""Crash safe spool directory (maildir like).
+
+Entries are written in ``tmp/`` and atomically renamed into ``new/``
+when complete. A consumer claims an entry by renaming it into
+``cur/``: only one consumer can succeed. Entry names contain the date
+after which they can be processed and the number of attempts.
+
+This module only uses the standard library, it can be imported by
+standalone scripts.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import os
+import select
+import time
+import uuid
+
+# inotify(7) constants
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+
+def pack(envelope, data):
+    """Build an entry from a JSON serializable envelope and data."""
+    return json.dumps(envelope).encode("utf-8") + b"\n" + data
+
+
+def unpack(content):
+    """Split an entry built by pack().
+
+    :return: a (envelope, data) tuple
+    """
+    envelope, data = content.split(b"\n", 1)
+    return json.loads(envelope.decode("utf-8")), data
+
+
+class SpoolEntry(object):
+    """An entry of the spool."""
+
+    def __init__(self, spool, name, path):
+        self.spool = spool
+        self.name = name
+        self.path = path
+        not_before, attempts, self.uid = name.split("_", 2)
+        self.not_before = int(not_before) / 1000000
+        self.attempts = int(attempts)
+
+    def read(self):
+        """Return the content of this entry."""
+        with open(self.path, "rb") as fp:
+            return fp.read()
+
+    def open(self):
+        """Return a binary file object."""
+        return open(self.path, "rb")
+
+
+class Spool(object):
+    """A directory based queue."""
+
+    def __init__(self, path):
+        self.path = path
+        for subdir in ("tmp", "new", "cur", "failed"):
+            os.makedirs(os.path.join(path, subdir), exist_ok=True)
+
+    def _name(self, not_before, attempts, uid=None):
+        return "{:017d}_{}_{}".format(
+            int(not_before * 1000000), attempts, uid or uuid.uuid4().hex)
+
+    def put(self, data, delay=0):
+        """Add a new entry, return its name."""
+        name = self._name(time.time() + delay, 0)
+        tmp_path = os.path.join(self.path, "tmp", name)
+        with open(tmp_path, "wb") as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp_path, os.path.join(self.path, "new", name))
+        return name
+
+    def pending(self):
+        """Return the names of waiting entries (oldest first)."""
+        return sorted(os.listdir(os.path.join(self.path, "new")))
+
+    def next_date(self):
+        """Return the date (timestamp) of the next entry, or None."""
+        pending = self.pending()
+        if not pending:
+            return None
+        return int(pending[0].split("_", 1)[0]) / 1000000
+
+    def claim(self, limit=None, now=None):
+        """Claim up to limit entries which are ready to be processed."""
+        if now is None:
+            now = time.time()
+        limit_name = self._name(now, 0, "~")
+        result = []
+        for name in self.pending():
+            if name > limit_name or (limit and len(result) >= limit):
+                break
+            path = os.path.join(self.path, "cur", name)
+            try:
+                new_path = os.path.join(self.path, "new", name)
+                # rename() keeps the mtime, recover() relies on it
+                os.utime(new_path)
+                os.rename(new_path, path)
+            except OSError as exc:
+                if exc.errno == errno.ENOENT:
+                    # Claimed by someone else
+                    continue
+                raise
+            result.append(SpoolEntry(self, name, path))
+        return result
+
+    def complete(self, entry):
+        """Remove a processed entry."""
+        os.unlink(entry.path)
+
+    def retry(self, entry, delay, count=True):
+        """Put an entry back in the queue, to be processed after delay.
+
+        :param bool count: increment the number of attempts
+        """
+        attempts = entry.attempts + 1 if count else entry.attempts
+        name = self._name(time.time() + delay, attempts, entry.uid)
+        os.utime(entry.path)
+        os.rename(entry.path, os.path.join(self.path, "new", name))
+
+    def fail(self, entry):
+        """Move an entry to the failed directory."""
+        os.rename(entry.path, os.path.join(self.path, "failed", entry.name))
+
+    def recover(self, older_than):
+        """Give back entries claimed by crashed consumers.
+
+        :param int older_than: minimum age (seconds) of claimed entries
+        :return: number of recovered entries
+        """
+        count = 0
+        limit = time.time() - older_than
+        cur = os.path.join(self.path, "cur")
+        for name in os.listdir(cur):
+            path = os.path.join(cur, name)
+            try:
+                if os.stat(path).st_mtime > limit:
+                    continue
+                os.rename(path, os.path.join(self.path, "new", name))
+            except FileNotFoundError:
+                continue
+            count += 1
+        return count
+
+
+class Watcher(object):
+    """Wait for new entries in a spool.
+
+    inotify is used when available (Linux), the directory is polled
+    otherwise.
+    """
+
+    def __init__(self, spool, poll_interval=1):
+        self.poll_interval = poll_interval
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(
+                ctypes.util.find_library("c") or None, use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                return
+            path = os.path.join(spool.path, "new").encode()
+            if libc.inotify_add_watch(fd, path, IN_MOVED_TO) < 0:
+                os.close(fd)
+                return
+        except (AttributeError, OSError):
+            # Not Linux
+            return
+        self.fd = fd
+
+    def wait(self, timeout):
+        """Wait for a new entry, at most timeout seconds."""
+        if self.fd is None:
+            time.sleep(min(timeout, self.poll_interval))
+            return
+        readable = select.select([self.fd], [], [], timeout)[0]
+        if not readable:
+            return
+        # Discard pending events
+        while True:
+            try:
+                os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Queue a message for the autoreply command running in spool mode.
+
+This script is meant to be invoked by Postfix's pipe(8) instead of
+``manage.py autoreply``. It only uses the standard library: the
+envelope and the message headers (the body is not needed) are written
+into the spool directory, then processed by batches by
+``manage.py autoreply --spool-dir``.
+
+Usage::
+
+  spoolclient.py --spool DIR <sender> <recipient> [<recipient> ...]
+
+Exits with EX_TEMPFAIL if the message can't be queued, so Postfix
+defers the delivery.
+"""
+
+import argparse
+import sys
+
+try:
+    from .spool import Spool, pack
+except ImportError:
+    # Executed as a script
+    from spool import Spool, pack
+
+EX_TEMPFAIL = 75
+MAX_HEADERS_SIZE = 1024 * 1024
+DRAIN_CHUNK_SIZE = 65536
+
+
+def read_headers(fp):
+    """Return the headers of the message read from fp, drain the body."""
+    headers = []
+    size = 0
+    for line in iter(lambda: fp.readline(65536), b""):
+        if line in (b"\r\n", b"\n"):
+            break
+        size += len(line)
+        if size > MAX_HEADERS_SIZE:
+            break
+        headers.append(line)
+    while fp.read(DRAIN_CHUNK_SIZE):
+        pass
+    return b"".join(headers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--spool", required=True)
+    parser.add_argument("sender")
+    parser.add_argument("recipient", nargs="+")
+    options = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    try:
+        headers = read_headers(sys.stdin.buffer)
+        Spool(options.spool).put(pack(
+            {"sender": options.sender, "recipients": options.recipient},
+            headers))
+    except OSError as exc:
+        sys.stderr.write("failed to queue message: {}\n".format(exc))
+        return EX_TEMPFAIL
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,12 +5,23 @@
 from __future__ import unicode_literals
 
 import datetime
+import os
+import shutil
+import smtplib
 import sys
+import tempfile
+import time
+from io import BytesIO, TextIOWrapper
 
 from dateutil.relativedelta import relativedelta
 from six import StringIO
 
 from django.core import mail, management
+from django.core.mail.backends import locmem
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.formats import date_format
@@ -20,7 +31,11 @@ from modoboa.core.models import User
 from modoboa.lib.tests import ModoTestCase, ModoAPITestCase
 from modoboa.transport import models as tr_models
 
-from . import factories, models
+from . import (
+    breaker, bulk, classifier, factories, forkserver, jobs, lib, lmtp,
+    metrics, models, outbox, pipeline, replies, routing, scheduler, smtp,
+    spool, spoolclient, throttle
+)
 
 SIMPLE_EMAIL_CONTENT = """
 From: Homer Simpson <homer@simpson.test>
@@ -163,6 +178,44 @@ class EventsTestCase(ModoTestCase):
                 address__contains="@test.fr"):
             self.assertIn("autoreply.test.fr", alr.address)
 
+    def test_rename_domain_routing_addresses(self):
+        """Only the domain part of routing addresses is replaced."""
+        mbox = admin_models.Mailbox.objects.get(
+            user__username="user@test.com")
+        factories.ARmessageFactory(mbox=mbox)
+        alias = admin_models.Alias.objects.get(
+            internal=True, address=mbox.full_address)
+        admin_factories.AliasRecipientFactory(
+            alias=alias, address="test.com@test.com@autoreply.test.com")
+        dom = mbox.domain
+        admin_models.Domain.objects.filter(pk=dom.pk).update(name="test.fr")
+        dom.refresh_from_db()
+        progress = []
+        done = routing.rename_domain(
+            dom, "test.com", chunk_size=1,
+            progress=lambda *args: progress.append(args))
+        self.assertEqual(done, 2)
+        self.assertEqual(progress, [(1, 2), (2, 2)])
+        self.assertEqual(
+            set(admin_models.AliasRecipient.objects.filter(
+                address__contains="@autoreply.").values_list(
+                    "address", flat=True)),
+            {"user@test.fr@autoreply.test.fr",
+             "test.com@test.fr@autoreply.test.fr"})
+        out = StringIO()
+        management.call_command(
+            "autoreply_rename_domain", "test.com", "test.fr", stdout=out)
+        self.assertIn("Nothing to update", out.getvalue())
+
+        admin_models.Domain.objects.filter(pk=dom.pk).update(name="test.com")
+        self.assertEqual(jobs.rename_domain(dom.pk, "test.fr", 1), 2)
+        self.assertEqual(
+            set(admin_models.AliasRecipient.objects.filter(
+                address__contains="@autoreply.").values_list(
+                    "address", flat=True)),
+            {"user@test.com@autoreply.test.com",
+             "test.com@test.com@autoreply.test.com"})
+
     def test_armessage_postsave_event(self):
         values = {
             "username": "leon@test.com",
@@ -193,6 +246,27 @@ class EventsTestCase(ModoTestCase):
                 address="leon@test.com@autoreply.test.com").exists()
         )
 
+    def test_armessage_routing_state(self):
+        """Aliases are only updated when the routing state changes."""
+        mbox = admin_models.Mailbox.objects.get(
+            user__username="user@test.com")
+        arm = factories.ARmessageFactory(mbox=mbox)
+        qset = admin_models.AliasRecipient.objects.filter(
+            address="user@test.com@autoreply.test.com")
+        self.assertTrue(qset.exists())
+        qset.delete()
+        arm = models.ARmessage.objects.get(pk=arm.pk)
+        arm.subject = "Out of office"
+        with self.assertNumQueries(1):
+            arm.save()
+        self.assertFalse(qset.exists())
+        arm.enabled = False
+        arm.save(update_fields=["enabled"])
+        self.assertFalse(qset.exists())
+        arm.enabled = True
+        arm.save()
+        self.assertTrue(qset.exists())
+
     def test_mailbox_deleted_event(self):
         account = User.objects.get(username="user@test.com")
         self.ajax_post(
@@ -235,6 +309,77 @@ class EventsTestCase(ModoTestCase):
                 address="leon@test.com@autoreply.test.com").exists()
         )
 
+    def _create_mailboxes(self, prefix, count=4):
+        domain = admin_models.Domain.objects.get(name="test.com")
+        result = []
+        for index in range(count):
+            mbox = admin_factories.MailboxFactory(
+                address="{}{}".format(prefix, index), domain=domain,
+                user__username="{}{}@test.com".format(prefix, index),
+                user__groups=("SimpleUsers", ))
+            factories.ARmessageFactory(mbox=mbox)
+            result.append(mbox)
+        return result
+
+    def _rename_and_delete(self, mailboxes):
+        """Rename half of mailboxes, delete the other half."""
+        half = len(mailboxes) // 2
+        for mbox in mailboxes[:half]:
+            mbox.old_full_address = mbox.full_address
+            mbox.address = "{}-renamed".format(mbox.address)
+            mbox.save()
+        for mbox in mailboxes[half:]:
+            mbox.delete()
+
+    def test_bulk_operation(self):
+        """Autoreply side effects are applied at the end."""
+        plain = self._create_mailboxes("plain")
+        with CaptureQueriesContext(connection) as plain_queries:
+            self._rename_and_delete(plain)
+
+        mailboxes = self._create_mailboxes("bulk")
+        with CaptureQueriesContext(connection) as bulk_queries:
+            with bulk.bulk_operation():
+                self._rename_and_delete(mailboxes)
+                admin_factories.DomainFactory(name="bulk.tld")
+                self.assertFalse(
+                    tr_models.Transport.objects.filter(
+                        pattern="autoreply.bulk.tld").exists())
+                self.assertFalse(
+                    routing.get_routing_recipients(
+                        ["bulk0-renamed@test.com"]).exists())
+        self.assertLess(
+            len(bulk_queries.captured_queries),
+            len(plain_queries.captured_queries))
+        self.assertIsNone(bulk.get_current())
+
+        self.assertTrue(
+            tr_models.Transport.objects.filter(
+                pattern="autoreply.bulk.tld").exists())
+        for prefix in ["plain", "bulk"]:
+            self.assertEqual(
+                sorted(routing.get_all_routing_recipients().filter(
+                    address__startswith=prefix).values_list(
+                        "address", flat=True)),
+                ["{}0-renamed@test.com@autoreply.test.com".format(prefix),
+                 "{}1-renamed@test.com@autoreply.test.com".format(prefix)])
+            self.assertFalse(
+                routing.get_routing_recipients(
+                    ["{}2@test.com".format(prefix),
+                     "{}3@test.com".format(prefix)]).exists())
+
+        # Objects and side effects are rolled back together
+        with self.assertRaises(RuntimeError):
+            with bulk.bulk_operation():
+                admin_factories.DomainFactory(name="rollback.tld")
+                raise RuntimeError("import failed")
+        self.assertIsNone(bulk.get_current())
+        self.assertFalse(
+            admin_models.Domain.objects.filter(name="rollback.tld").exists())
+        self.assertFalse(
+            tr_models.Transport.objects.filter(
+                pattern="autoreply.rollback.tld").exists())
+
 
 class FormTestCase(ModoTestCase):
 
@@ -338,6 +483,55 @@ class RepairTestCase(ModoTestCase):
             admin_models.AliasRecipient.objects.filter(
                 address=ar_address).exists())
 
+    def test_reconcile(self):
+        """Missing routing aliases are created, stale ones deleted."""
+        mbox = admin_models.Mailbox.objects.get(user__username="user@test.com")
+        factories.ARmessageFactory(mbox=mbox)
+        routed = admin_models.AliasRecipient.objects.filter(
+            address="user@test.com@autoreply.test.com")
+        routed.delete()
+        mbox = admin_models.Mailbox.objects.get(
+            user__username="admin@test.com")
+        alias = admin_models.Alias.objects.get(
+            internal=True, address=mbox.full_address)
+        stale = admin_factories.AliasRecipientFactory(
+            alias=alias, address="admin@test.com@autoreply.test.com")
+
+        out = StringIO()
+        management.call_command(
+            "autoreply_reconcile", "--dry-run", stdout=out)
+        self.assertIn("+ user@test.com@autoreply.test.com", out.getvalue())
+        self.assertIn("- admin@test.com@autoreply.test.com", out.getvalue())
+        self.assertFalse(routed.exists())
+        self.assertTrue(
+            admin_models.AliasRecipient.objects.filter(pk=stale.pk).exists())
+
+        management.call_command("modo", "repair", "--quiet")
+        self.assertTrue(routed.exists())
+        self.assertFalse(
+            admin_models.AliasRecipient.objects.filter(pk=stale.pk).exists())
+        out = StringIO()
+        management.call_command("autoreply_reconcile", stdout=out)
+        self.assertIn("0 routing alias(es) created, 0 deleted", out.getvalue())
+
+    def test_routing_lookups(self):
+        """Routing recipients are found with exact addresses."""
+        mbox = admin_models.Mailbox.objects.get(user__username="user@test.com")
+        alias = admin_models.Alias.objects.get(
+            internal=True, address=mbox.full_address)
+        factories.ARmessageFactory(mbox=mbox)
+        # Not a routing address of this mailbox
+        admin_factories.AliasRecipientFactory(
+            alias=alias, address="user@test.com@autoreply.test.fr")
+        expected = ["user@test.com@autoreply.test.com"]
+        self.assertEqual(
+            list(routing.get_all_routing_recipients().values_list(
+                "address", flat=True)), expected)
+        self.assertEqual(
+            list(routing.get_routing_recipients([
+                mbox.full_address, "unknown@test.com"]).values_list(
+                    "address", flat=True)), expected)
+
 
 class ManagementCommandTestCase(ModoTestCase):
     """Management command related tests."""
@@ -374,6 +568,23 @@ class ManagementCommandTestCase(ModoTestCase):
             "autoreply", "homer@simpson.test", "user@test.com")
         self.assertEqual(len(mail.outbox), 1)
 
+    def test_claim_reply_slot(self):
+        """Check the reservation of a reply slot."""
+        manager = models.ARhistoric.objects
+        claimed = manager.claim(self.arm, "homer@simpson.test", 3600)
+        self.assertIsNotNone(claimed)
+        self.assertIsNone(manager.claim(self.arm, "homer@simpson.test", 3600))
+        self.assertIsNotNone(manager.claim(self.arm, "bart@simpson.test", 3600))
+        manager.filter(sender="homer@simpson.test").update(
+            last_sent=timezone.now() - relativedelta(hours=2))
+        claimed = manager.claim(self.arm, "homer@simpson.test", 3600)
+        self.assertIsNotNone(claimed)
+        self.assertEqual(
+            manager.filter(sender="homer@simpson.test").count(), 1)
+        manager.release(self.arm, "homer@simpson.test", claimed)
+        self.assertFalse(
+            manager.filter(sender="homer@simpson.test").exists())
+
     def test_armessage_date_constraints(self):
         """Check date constraints."""
         account = User.objects.get(username="admin@test.com")
@@ -400,6 +611,289 @@ class ManagementCommandTestCase(ModoTestCase):
             "autoreply", "homer@simpson.com", "pouet@test.fr")
         self.assertEqual(len(mail.outbox), 0)
 
+    def test_recipients_lookup_queries(self):
+        """Recipients are resolved using a single query."""
+        with self.assertNumQueries(1):
+            management.call_command(
+                "autoreply", "homer@simpson.test", "admin@test.com",
+                "pouet@test.fr", "user@test2.com")
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_pipeline_early_exit(self):
+        """Message headers are not parsed if no reply is needed."""
+        pipeline.stats.reset()
+        management.call_command(
+            "autoreply", "homer@simpson.test", "nobody@test.com")
+        stats = pipeline.stats.snapshot()
+        self.assertEqual(stats["recipient"][:2], (1, 1))
+        self.assertEqual(stats["headers"][0], 0)
+        sys.stdin.seek(0)
+        management.call_command(
+            "autoreply", "homer@simpson.test", "user@test.com")
+        stats = pipeline.stats.snapshot()
+        self.assertEqual(stats["send"][:2], (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_bulk_message_queries(self):
+        """No reservation is made for bulk messages."""
+        sys.stdin = StringIO(EMAIL_FROM_ML_CONTENT.strip())
+        with CaptureQueriesContext(connection) as ctx:
+            management.call_command(
+                "autoreply", "homer@simpson.test", "user@test.com")
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual([
+            query["sql"] for query in ctx.captured_queries
+            if "arhistoric" in query["sql"] and
+            not query["sql"].lstrip().upper().startswith("SELECT")
+        ], [])
+
+    def test_metrics_textfile(self):
+        """Check metrics are cumulated in the textfile."""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        textfile = os.path.join(path, "autoreply.prom")
+        metrics.registry.collect(reset=True)
+        with self.settings(AUTOREPLY_METRICS_TEXTFILE=textfile):
+            management.call_command(
+                "autoreply", "homer@simpson.test", "user@test.com")
+            sys.stdin.seek(0)
+            management.call_command(
+                "autoreply", "homer@simpson.test", "user@test.com",
+                "nobody@test.com")
+        with open(textfile) as fp:
+            content = fp.read()
+        self.assertIn("autoreply_messages_received_total 2", content)
+        self.assertIn("autoreply_replies_sent_total 1", content)
+        self.assertIn(
+            'autoreply_recipients_skipped_total{reason="throttled"} 1',
+            content)
+        self.assertIn(
+            'autoreply_recipients_skipped_total{reason="no_autoreply"} 1',
+            content)
+        self.assertIn(
+            'autoreply_stage_duration_seconds_count{stage="send"} 1',
+            content)
+
+    def test_replay_command(self):
+        """Replay a directory of messages."""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        for index, content in enumerate([
+                EMAIL_FROM_ML_CONTENT, SIMPLE_EMAIL_CONTENT,
+                SIMPLE_EMAIL_CONTENT]):
+            with open(os.path.join(path, "{}.eml".format(index)), "w") as fp:
+                fp.write(content.strip())
+        out = StringIO()
+        management.call_command(
+            "autoreply_replay", path, stdout=out)
+        output = out.getvalue()
+        self.assertIn("3 messages in", output)
+        self.assertIn("sent: 1", output)
+        self.assertIn("rejected by throttle: 1", output)
+        self.assertIn("rejected by headers: 1", output)
+        self.assertIn("throttled: 1", output)
+
+        outbox_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outbox_path)
+        self.addCleanup(outbox.get_outbox.cache_clear)
+        models.ARhistoric.objects.all().delete()
+        with self.settings(AUTOREPLY_OUTBOX_DIR=outbox_path):
+            outbox.get_outbox.cache_clear()
+            out = StringIO()
+            management.call_command("autoreply_replay", path, stdout=out)
+            self.assertIn("sent: 1", out.getvalue())
+            # Replayed replies are never queued for real delivery
+            self.assertEqual(outbox.get_outbox().pending(), [])
+
+    def test_profiling(self):
+        """Check profiles are written and merged."""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        management.call_command(
+            "autoreply", "homer@simpson.test", "user@test.com",
+            profile_dir=path, profile_sample_rate=0)
+        self.assertEqual(os.listdir(path), [])
+        sys.stdin.seek(0)
+        management.call_command(
+            "autoreply", "homer@simpson.test", "user@test.com",
+            profile_dir=path)
+        self.assertEqual(len(os.listdir(path)), 1)
+        self.assertTrue(os.listdir(path)[0].endswith(
+            "-{}.pstats".format(os.getpid())))
+        out = StringIO()
+        management.call_command(
+            "autoreply_profile_report", path, "--limit", "5", stdout=out)
+        self.assertIn("1 profile(s)", out.getvalue())
+        self.assertIn("process", out.getvalue())
+
+    def test_multiple_recipients(self):
+        """Check multi recipients delivery."""
+        account = User.objects.get(username="admin@test.com")
+        factories.ARmessageFactory(mbox=account.mailbox)
+        management.call_command(
+            "autoreply", "homer@simpson.test", "user@test.com",
+            "pouet@test.fr", "admin@test.com")
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_concurrent_replies(self):
+        """Replies are sent concurrently, failures are isolated."""
+        for username in ["admin@test.com", "user@test.com"]:
+            account = User.objects.get(username=username)
+            factories.ARmessageFactory(mbox=account.mailbox)
+        recipients = ["user@test.com", "admin@test.com"]
+        management.call_command(
+            "autoreply", "homer@simpson.test", *recipients, concurrency=2)
+        self.assertEqual(
+            [msg.to for msg in mail.outbox],
+            [["homer@simpson.test"], ["homer@simpson.test"]])
+        self.assertEqual(models.ARhistoric.objects.count(), 2)
+
+        mail.outbox = []
+        with self.settings(
+                EMAIL_BACKEND="modoboa_postfix_autoreply.tests."
+                              "BrokenEmailBackend"):
+            pipe = pipeline.Pipeline(
+                "bart@simpson.test", recipients,
+                lambda: lib.read_message_headers(
+                    BytesIO(SIMPLE_EMAIL_CONTENT.strip().encode("utf-8"))),
+                concurrency=2)
+            failures = pipe.run()
+        self.assertEqual(sorted(failures), sorted(recipients))
+        # Reservations are cancelled
+        self.assertFalse(models.ARhistoric.objects.filter(
+            sender="bart@simpson.test").exists())
+
+    def test_spool_mode(self):
+        """Messages queued by spoolclient are processed by batches."""
+        account = User.objects.get(username="user@test.com")
+        factories.ARmessageFactory(mbox=account.mailbox)
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        queue = spool.Spool(path)
+        for sender, content in [
+                ("homer@simpson.test", SIMPLE_EMAIL_CONTENT),
+                ("homer@simpson.test", SIMPLE_EMAIL_CONTENT),
+                ("marge@simpson.test", EMAIL_FROM_ML_CONTENT)]:
+            headers = spoolclient.read_headers(
+                BytesIO(content.strip().encode("utf-8")))
+            queue.put(spool.pack(
+                {"sender": sender, "recipients": ["user@test.com"]},
+                headers))
+        queue.put(b"invalid")
+        management.call_command("autoreply", spool_dir=path)
+        # Second message is throttled, third one comes from a list
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["homer@simpson.test"])
+        self.assertEqual(queue.pending(), [])
+        self.assertEqual(os.listdir(os.path.join(path, "cur")), [])
+        self.assertEqual(len(os.listdir(os.path.join(path, "failed"))), 1)
+
+        with self.assertRaises(management.CommandError):
+            management.call_command("autoreply")
+
+    def test_tempfail(self):
+        """Transient failures defer the message, the circuit opens."""
+        account = User.objects.get(username="user@test.com")
+        factories.ARmessageFactory(mbox=account.mailbox)
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        state = os.path.join(path, "breaker")
+        with self.settings(
+                EMAIL_BACKEND="modoboa_postfix_autoreply.tests."
+                              "BrokenEmailBackend",
+                AUTOREPLY_CIRCUIT_BREAKER={"PATH": state, "THRESHOLD": 1}):
+            with self.assertRaises(SystemExit) as cm:
+                management.call_command(
+                    "autoreply", "homer@simpson.test", "user@test.com")
+            self.assertEqual(cm.exception.code, 75)
+            # Reservation is cancelled so the retry can send the reply
+            self.assertFalse(models.ARhistoric.objects.exists())
+            self.assertFalse(breaker.get_breaker().allow())
+            # Rejected without touching the database
+            with self.assertNumQueries(0):
+                with self.assertRaises(SystemExit) as cm:
+                    management.call_command(
+                        "autoreply", "homer@simpson.test", "user@test.com")
+            self.assertEqual(cm.exception.code, 75)
+
+        with self.settings(
+                AUTOREPLY_CIRCUIT_BREAKER={"PATH": state, "COOLDOWN": 0}):
+            sys.stdin = StringIO(SIMPLE_EMAIL_CONTENT.strip())
+            management.call_command(
+                "autoreply", "homer@simpson.test", "user@test.com")
+            self.assertEqual(len(mail.outbox), 1)
+            self.assertTrue(breaker.get_breaker().allow())
+
+    def test_deadline_after_claim(self):
+        """Reservations are cancelled when the deadline is exceeded."""
+        account = User.objects.get(username="user@test.com")
+        factories.ARmessageFactory(mbox=account.mailbox)
+
+        class SlowBuffer(BytesIO):
+            """Exceed the deadline while headers are read."""
+
+            def readline(self, *args):
+                raise breaker.DeadlineExceeded("deadline of 1s exceeded")
+
+        sys.stdin = TextIOWrapper(SlowBuffer())
+        with self.assertRaises(SystemExit) as cm:
+            management.call_command(
+                "autoreply", "homer@simpson.test", "user@test.com")
+        self.assertEqual(cm.exception.code, 75)
+        self.assertFalse(models.ARhistoric.objects.exists())
+        self.assertEqual(len(mail.outbox), 0)
+
+        # Postfix retries the delivery
+        sys.stdin = StringIO(SIMPLE_EMAIL_CONTENT.strip())
+        management.call_command(
+            "autoreply", "homer@simpson.test", "user@test.com")
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_deadline_during_send(self):
+        """The message is deferred when the deadline fires while sending."""
+        account = User.objects.get(username="admin@test.com")
+        factories.ARmessageFactory(mbox=account.mailbox)
+        with self.settings(
+                EMAIL_BACKEND="modoboa_postfix_autoreply.tests."
+                              "DeadlineEmailBackend"):
+            with self.assertRaises(SystemExit) as cm:
+                management.call_command(
+                    "autoreply", "homer@simpson.test", "admin@test.com")
+        self.assertEqual(cm.exception.code, 75)
+        self.assertFalse(models.ARhistoric.objects.exists())
+        self.assertEqual(len(mail.outbox), 0)
+
+        # Replies sent before the deadline keep their reservation
+        sys.stdin = StringIO(SIMPLE_EMAIL_CONTENT.strip())
+        with self.settings(
+                EMAIL_BACKEND="modoboa_postfix_autoreply.tests."
+                              "DeadlineEmailBackend"):
+            with self.assertRaises(SystemExit) as cm:
+                management.call_command(
+                    "autoreply", "homer@simpson.test", "user@test.com",
+                    "admin@test.com", concurrency=1)
+        self.assertEqual(cm.exception.code, 75)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(
+            list(models.ARhistoric.objects.values_list(
+                "armessage__mbox__address", flat=True)), ["user"])
+
+        # Postfix retries the delivery, user@test.com is not replied twice
+        sys.stdin = StringIO(SIMPLE_EMAIL_CONTENT.strip())
+        management.call_command(
+            "autoreply", "homer@simpson.test", "user@test.com",
+            "admin@test.com", concurrency=1)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertIn("admin@test.com", mail.outbox[1].from_email)
+
+    def test_recipient_case(self):
+        """Recipients are matched whatever the database collation."""
+        result = lib.get_armessages(["User@Test.com", "user@test.com"])
+        self.assertEqual(result["user@test.com"], self.arm)
+        self.assertEqual(result.get("User@Test.com", self.arm), self.arm)
+        management.call_command(
+            "autoreply", "homer@simpson.test", "User@Test.com")
+
     def test_no_ar_message_defined(self):
         """No AR defined for local recipient."""
         management.call_command(
@@ -425,6 +919,52 @@ class ManagementCommandTestCase(ModoTestCase):
             "autoreply", "sender@list.test", "user@test.com")
         self.assertEqual(len(mail.outbox), 0)
 
+    def test_automatic_message(self):
+        """Automatic or spam messages don't get a reply."""
+        headers = [
+            "Auto-Submitted: auto-replied",
+            "Precedence: junk",
+            "X-Auto-Response-Suppress: DR, OOF",
+            "X-Spam-Flag: YES",
+        ]
+        for header in headers:
+            sys.stdin = StringIO(SIMPLE_EMAIL_CONTENT.strip().replace(
+                "Subject: Test", "Subject: Test\n" + header))
+            management.call_command(
+                "autoreply", "homer@simpson.test", "user@test.com")
+            self.assertEqual(len(mail.outbox), 0, header)
+        self.assertFalse(models.ARhistoric.objects.exists())
+        sys.stdin = StringIO(SIMPLE_EMAIL_CONTENT.strip().replace(
+            "Subject: Test", "Subject: Test\nAuto-Submitted: no"))
+        management.call_command(
+            "autoreply", "homer@simpson.test", "user@test.com")
+        self.assertEqual(len(mail.outbox), 1)
+
+    @override_settings(AUTOREPLY_BULK_RULES={
+        "SENDER_SUFFIXES": ["-bounces"],
+        "HEADERS": {
+            "X-Campaign": None, "List-Id": False, "List-Archive": False
+        }
+    })
+    def test_custom_bulk_rules(self):
+        """Check bulk rules can be configured."""
+        classifier.get_classifier.cache_clear()
+        self.addCleanup(classifier.get_classifier.cache_clear)
+        self.assertTrue(lib.is_mailing_list_sender("news-bounces@list.test"))
+        self.assertFalse(lib.is_mailing_list_sender("homer-request@test"))
+        self.assertTrue(lib.is_mailing_list_sender("owner-news@list.test"))
+        # Header rules are merged with default ones
+        for header in ["X-Campaign: spring", "List-Unsubscribe: <x@y.test>"]:
+            msg = lib.read_message_headers(BytesIO(
+                SIMPLE_EMAIL_CONTENT.strip().replace(
+                    "Subject: Test", "Subject: Test\n" + header
+                ).encode("utf-8")))
+            self.assertTrue(lib.is_mailing_list_message(msg))
+        sys.stdin = StringIO(EMAIL_FROM_ML_CONTENT.strip())
+        management.call_command(
+            "autoreply", "homer@simpson.test", "user@test.com")
+        self.assertEqual(len(mail.outbox), 1)
+
     def test_variable_substitution(self):
         """Check when message contains variables."""
         tz = timezone.get_current_timezone()
@@ -455,6 +995,30 @@ class ManagementCommandTestCase(ModoTestCase):
             mail.outbox[0].body.strip()
         )
 
+    def test_reply_template_cache(self):
+        """Check precompiled replies are reused and invalidated."""
+        replies.templates.clear()
+        management.call_command(
+            "autoreply", "homer@simpson.test", "user@test.com")
+        self.assertEqual(len(replies.templates.entries), 1)
+        sys.stdin.seek(0)
+        management.call_command(
+            "autoreply", "bart@simpson.test", "user@test.com")
+        self.assertEqual(len(replies.templates.entries), 1)
+        self.assertEqual(mail.outbox[0].body, mail.outbox[1].body)
+        self.assertEqual(mail.outbox[1].to, ["bart@simpson.test"])
+        self.arm.content = "Gone fishing"
+        self.arm.save()
+        self.assertEqual(len(replies.templates.entries), 0)
+        sys.stdin.seek(0)
+        management.call_command(
+            "autoreply", "lisa@simpson.test", "user@test.com")
+        self.assertEqual(mail.outbox[2].body, "Gone fishing")
+        self.assertEqual(
+            mail.outbox[2].extra_headers["In-Reply-To"],
+            "<CAN0378wA1V0VJg5OxyavB2uJgAimMc2ttGSc-yvWsXTaKqnKuw@"
+            "simpson.test>")
+
     def test_message_with_bad_headers(self):
         """Message received with bad header (including newline)"""
         sys.stdin = StringIO(SIMPLE_EMAIL_CONTENT_WITH_BAD_HEADER.strip())
@@ -462,6 +1026,353 @@ class ManagementCommandTestCase(ModoTestCase):
             "autoreply", "homer@simpson.test", "user@test.com")
         self.assertEqual(len(mail.outbox), 1)
 
+    def test_binary_stdin(self):
+        """Only headers are parsed, the body is drained."""
+        content = (
+            SIMPLE_EMAIL_CONTENT.strip().replace("Subject: Test",
+                                                 "Subject: Caf\xe9") +
+            "\n" + "x" * 1024 * 1024
+        )
+        raw = BytesIO(content.encode("latin-1"))
+        sys.stdin = TextIOWrapper(raw)
+        management.call_command(
+            "autoreply", "homer@simpson.test", "user@test.com")
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn("Re: Caf", mail.outbox[0].subject)
+        self.assertEqual(raw.read(), b"")
+
+    def test_forkserver_run_command(self):
+        """Check exit codes returned to fork server clients."""
+        code = forkserver.run_command(["homer@simpson.test", "user@test.com"])
+        self.assertEqual(code, 0)
+        self.assertEqual(len(mail.outbox), 1)
+        # Missing recipient argument
+        self.assertNotEqual(forkserver.run_command(["homer@simpson.test"]), 0)
+
+
+class LMTPSessionTestCase(ModoTestCase):
+    """LMTP server related tests."""
+
+    @classmethod
+    def setUpTestData(cls):  # NOQA:N802
+        """Create some data."""
+        super(LMTPSessionTestCase, cls).setUpTestData()
+        admin_factories.populate_database()
+        cls.account = User.objects.get(username="user@test.com")
+        cls.arm = factories.ARmessageFactory(mbox=cls.account.mailbox)
+
+    def _run_session(self, sender, recipients, content):
+        commands = ["LHLO localhost", "MAIL FROM:<{}>".format(sender)]
+        commands += ["RCPT TO:<{}>".format(rcpt) for rcpt in recipients]
+        commands += ["DATA", content.strip().replace("\n", "\r\n"), ".",
+                     "QUIT"]
+        rfile = BytesIO("\r\n".join(commands).encode("utf-8") + b"\r\n")
+        wfile = BytesIO()
+        lmtp.LMTPSession(rfile, wfile, "localhost").run()
+        return wfile.getvalue().decode("utf-8").splitlines()
+
+    def test_simple_case(self):
+        """Check basic autoreply."""
+        replies = self._run_session(
+            "homer@simpson.test",
+            ["user@test.com@autoreply.test.com",
+             "admin@test.com@autoreply.test.com"],
+            SIMPLE_EMAIL_CONTENT)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["homer@simpson.test"])
+        self.assertIn(
+            "250 2.0.0 <user@test.com@autoreply.test.com> Ok", replies)
+        self.assertIn(
+            "250 2.0.0 <admin@test.com@autoreply.test.com> Ok", replies)
+        self.assertEqual(replies[-1], "221 2.0.0 Bye")
+
+    def test_quoted_recipient(self):
+        """Postfix quotes local parts containing a @."""
+        replies = self._run_session(
+            "homer@simpson.test", ['"user@test.com"@autoreply.test.com'],
+            SIMPLE_EMAIL_CONTENT)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["homer@simpson.test"])
+        self.assertIn(
+            '250 2.0.0 <"user@test.com"@autoreply.test.com> Ok', replies)
+
+    def test_message_from_ml(self):
+        """Message received from a mailing list."""
+        replies = self._run_session(
+            "sender@list.test", ["user@test.com@autoreply.test.com"],
+            EMAIL_FROM_ML_CONTENT)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertIn(
+            "250 2.0.0 <user@test.com@autoreply.test.com> Ok", replies)
+
+    def test_smtp_pool(self):
+        """Check SMTP connections are reused."""
+        pool = smtp.ConnectionPool(max_size=1, idle_timeout=60)
+        with pool.connection() as connection:
+            pass
+        with pool.connection() as connection2:
+            self.assertIs(connection, connection2)
+        rfile = BytesIO()
+        wfile = BytesIO()
+        session = lmtp.LMTPSession(rfile, wfile, "localhost", pool)
+        session.sender = "homer@simpson.test"
+        session.recipients = ["user@test.com@autoreply.test.com"]
+        original_msg = lib.read_message_headers(
+            BytesIO(SIMPLE_EMAIL_CONTENT.strip().encode("utf-8")))
+        self.assertEqual(
+            session.process(original_msg),
+            ["250 2.0.0 <user@test.com@autoreply.test.com> Ok"])
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(len(pool.idle), 1)
+        pool.idle_timeout = 0
+        pool.close_idle()
+        self.assertEqual(len(pool.idle), 0)
+
+    def test_bad_sequence(self):
+        """Check protocol errors."""
+        rfile = BytesIO(b"DATA\r\nRCPT TO:<user@test.com>\r\nQUIT\r\n")
+        wfile = BytesIO()
+        lmtp.LMTPSession(rfile, wfile, "localhost").run()
+        replies = wfile.getvalue().decode("utf-8").splitlines()
+        self.assertEqual(replies[1], "503 5.5.1 Need RCPT command")
+        self.assertEqual(replies[2], "503 5.5.1 Need MAIL command")
+
+
+class ThrottleBackendTestCase(ModoTestCase):
+    """Throttle backends related tests."""
+
+    @classmethod
+    def setUpTestData(cls):  # NOQA:N802
+        """Create some data."""
+        super(ThrottleBackendTestCase, cls).setUpTestData()
+        admin_factories.populate_database()
+        account = User.objects.get(username="user@test.com")
+        cls.arm = factories.ARmessageFactory(mbox=account.mailbox)
+
+    def tearDown(self):
+        throttle.get_backend.cache_clear()
+
+    def _check_backend(self, backend):
+        sender = "homer@simpson.test"
+        token = backend.claim(self.arm, sender, 3600)
+        self.assertIsNotNone(token)
+        self.assertIsNone(backend.claim(self.arm, sender, 3600))
+        self.assertIsNotNone(backend.claim(self.arm, "bart@simpson.test", 3600))
+        backend.release(self.arm, sender, token)
+        self.assertIsNotNone(backend.claim(self.arm, sender, 3600))
+
+    def test_database_backend(self):
+        self._check_backend(throttle.DatabaseThrottleBackend())
+
+    def test_memory_backend(self):
+        backend = throttle.MemoryThrottleBackend(max_entries=2)
+        self._check_backend(backend)
+        self.assertEqual(len(backend.entries), 2)
+        # Expired entries don't block replies
+        self.assertIsNotNone(backend.claim(self.arm, "lisa@simpson.test", 0))
+        self.assertIsNotNone(backend.claim(self.arm, "lisa@simpson.test", 0))
+
+    def test_cache_backend(self):
+        backend = throttle.CacheThrottleBackend()
+        backend.cache.clear()
+        self._check_backend(backend)
+
+    @override_settings(AUTOREPLY_THROTTLE={
+        "BACKEND": "modoboa_postfix_autoreply.throttle.MemoryThrottleBackend"
+    })
+    def test_configured_backend(self):
+        throttle.get_backend.cache_clear()
+        self.assertIsInstance(
+            throttle.get_backend(), throttle.MemoryThrottleBackend)
+        stdin = sys.stdin
+        sys.stdin = StringIO(SIMPLE_EMAIL_CONTENT.strip())
+        try:
+            management.call_command(
+                "autoreply", "homer@simpson.test", "user@test.com")
+        finally:
+            sys.stdin = stdin
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(models.ARhistoric.objects.exists())
+
+
+class SchedulerTestCase(ModoTestCase):
+    """Activation/expiration scheduler related tests."""
+
+    @classmethod
+    def setUpTestData(cls):  # NOQA:N802
+        """Create some data."""
+        super(SchedulerTestCase, cls).setUpTestData()
+        admin_factories.populate_database()
+        cls.account = User.objects.get(username="user@test.com")
+        cls.ar_address = "user@test.com@autoreply.test.com"
+
+    def _routing_alias_exists(self):
+        return admin_models.AliasRecipient.objects.filter(
+            address=self.ar_address).exists()
+
+    def test_activation(self):
+        fromdate = timezone.now() + relativedelta(days=1)
+        factories.ARmessageFactory(
+            mbox=self.account.mailbox, fromdate=fromdate)
+        self.assertFalse(self._routing_alias_exists())
+        self.assertEqual(scheduler.next_transition(), fromdate)
+        result = scheduler.apply_transitions(
+            now=fromdate + relativedelta(minutes=1),
+            since=fromdate - relativedelta(minutes=1))
+        self.assertEqual(result, (1, 0))
+        self.assertTrue(self._routing_alias_exists())
+
+    def test_expiration(self):
+        untildate = timezone.now() + relativedelta(days=1)
+        arm = factories.ARmessageFactory(
+            mbox=self.account.mailbox, untildate=untildate)
+        self.assertTrue(self._routing_alias_exists())
+        self.assertEqual(scheduler.next_transition(), untildate)
+        result = scheduler.apply_transitions(
+            now=untildate + relativedelta(minutes=1))
+        self.assertEqual(result, (0, 1))
+        self.assertFalse(self._routing_alias_exists())
+        arm.refresh_from_db()
+        self.assertFalse(arm.enabled)
+
+    def test_management_command(self):
+        arm = factories.ARmessageFactory(mbox=self.account.mailbox)
+        admin_models.AliasRecipient.objects.filter(
+            address=self.ar_address).delete()
+        management.call_command(
+            "autoreply_scheduler", "--all", stdout=StringIO())
+        self.assertTrue(self._routing_alias_exists())
+        models.ARmessage.objects.filter(pk=arm.pk).update(
+            untildate=timezone.now() - relativedelta(minutes=1))
+        management.call_command("autoreply_scheduler", stdout=StringIO())
+        self.assertFalse(self._routing_alias_exists())
+
+
+class PruneCommandTestCase(ModoTestCase):
+    """autoreply_prune command related tests."""
+
+    @classmethod
+    def setUpTestData(cls):  # NOQA:N802
+        """Create some data."""
+        super(PruneCommandTestCase, cls).setUpTestData()
+        admin_factories.populate_database()
+        account = User.objects.get(username="user@test.com")
+        cls.arm = factories.ARmessageFactory(mbox=account.mailbox)
+        account = User.objects.get(username="admin@test.com")
+        cls.arm2 = factories.ARmessageFactory(
+            mbox=account.mailbox, enabled=False)
+        for sender in ["homer@simpson.test", "bart@simpson.test"]:
+            models.ARhistoric.objects.create(armessage=cls.arm, sender=sender)
+            models.ARhistoric.objects.create(armessage=cls.arm2, sender=sender)
+        models.ARhistoric.objects.filter(
+            armessage=cls.arm, sender="bart@simpson.test").update(
+                last_sent=timezone.now() - relativedelta(days=2))
+
+    def test_dry_run(self):
+        out = StringIO()
+        management.call_command("autoreply_prune", "--dry-run", stdout=out)
+        self.assertIn("Disabled messages: 2 entries", out.getvalue())
+        self.assertIn("Expired entries: 1 entries", out.getvalue())
+        self.assertEqual(models.ARhistoric.objects.count(), 4)
+
+    def test_prune(self):
+        management.call_command(
+            "autoreply_prune", "--batch-size", "1", stdout=StringIO())
+        self.assertEqual(
+            list(models.ARhistoric.objects.values_list("sender", flat=True)),
+            ["homer@simpson.test"])
+
+
+class BrokenEmailBackend(BaseEmailBackend):
+    """An email backend which always fails."""
+
+    def send_messages(self, email_messages):
+        raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+
+
+class DeadlineEmailBackend(locmem.EmailBackend):
+    """Exceed the deadline while sending replies of admin@test.com."""
+
+    def send_messages(self, email_messages):
+        for message in email_messages:
+            if "admin@test.com" in message.from_email:
+                raise breaker.DeadlineExceeded("deadline of 1s exceeded")
+        return super(DeadlineEmailBackend, self).send_messages(
+            email_messages)
+
+
+class OutboxTestCase(ModoTestCase):
+    """Outgoing queue related tests."""
+
+    @classmethod
+    def setUpTestData(cls):  # NOQA:N802
+        """Create some data."""
+        super(OutboxTestCase, cls).setUpTestData()
+        admin_factories.populate_database()
+        account = User.objects.get(username="user@test.com")
+        cls.arm = factories.ARmessageFactory(mbox=account.mailbox)
+
+    def setUp(self):
+        """Use a temporary outbox."""
+        super(OutboxTestCase, self).setUp()
+        self.path = tempfile.mkdtemp()
+        settings_override = override_settings(AUTOREPLY_OUTBOX_DIR=self.path)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(shutil.rmtree, self.path)
+        self.addCleanup(outbox.get_outbox.cache_clear)
+        outbox.get_outbox.cache_clear()
+        self.stdin = sys.stdin
+        sys.stdin = StringIO(SIMPLE_EMAIL_CONTENT.strip())
+
+    def tearDown(self):
+        """Restore stdin."""
+        sys.stdin = self.stdin
+
+    def test_queue_and_send(self):
+        management.call_command(
+            "autoreply", "homer@simpson.test", "user@test.com")
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(len(outbox.get_outbox().pending()), 1)
+        management.call_command("autoreply_outbox")
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["homer@simpson.test"])
+        self.assertEqual(
+            mail.outbox[0].message()["Auto-Submitted"], "auto-replied")
+        self.assertEqual(len(outbox.get_outbox().pending()), 0)
+
+    def test_retry(self):
+        management.call_command(
+            "autoreply", "homer@simpson.test", "user@test.com")
+        spool = outbox.get_outbox()
+        connection = BrokenEmailBackend()
+        self.assertEqual(
+            outbox.flush(spool, connection=connection), (0, 1, 0))
+        # Not ready yet
+        self.assertEqual(
+            outbox.flush(spool, connection=connection), (0, 0, 0))
+        entry = spool.claim(now=time.time() + 86400)[0]
+        self.assertEqual(entry.attempts, 1)
+        spool.retry(entry, 0, count=False)
+        self.assertEqual(
+            outbox.flush(spool, max_attempts=2, connection=connection),
+            (0, 0, 1))
+        self.assertEqual(spool.pending(), [])
+
+    def test_recover(self):
+        """Only entries claimed a long time ago are recovered."""
+        queue = outbox.get_outbox()
+        name = queue.put(b"data")
+        path = os.path.join(self.path, "new", name)
+        old = time.time() - 7200
+        os.utime(path, (old, old))
+        entry = queue.claim()[0]
+        self.assertEqual(queue.recover(3600), 0)
+        self.assertTrue(os.path.exists(entry.path))
+        os.utime(entry.path, (old, old))
+        self.assertEqual(queue.recover(3600), 1)
+        self.assertEqual(queue.pending(), [name])
+
 
 class ARMessageViewSetTestCase(ModoAPITestCase):
     """API test case."""
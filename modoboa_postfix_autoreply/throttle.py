@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+"""
+Backends used to remember when a reply was sent to a sender.
+
+The backend is selected with the ``AUTOREPLY_THROTTLE`` setting::
+
+  AUTOREPLY_THROTTLE = {
+      "BACKEND": "modoboa_postfix_autoreply.throttle.CacheThrottleBackend",
+      "OPTIONS": {"cache": "autoreply"}
+  }
+
+The database is used by default.
+"""
+
+import collections
+import functools
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from .models import ARhistoric
+
+DEFAULT_BACKEND = "modoboa_postfix_autoreply.throttle.DatabaseThrottleBackend"
+
+
+class BaseThrottleBackend(object):
+    """Base class of throttle backends."""
+
+    def __init__(self, **options):
+        self.options = options
+
+    def claim(self, armessage, sender, timeout):
+        """Reserve the right to send a reply to sender.
+
+        Must be atomic: concurrent calls for the same sender can't
+        both succeed.
+
+        :param armessage: ``ARmessage`` instance
+        :param str sender: address the reply will be sent to
+        :param int timeout: minimum delay (in seconds) between two replies
+        :return: a reservation token if the reply can be sent, else None
+        """
+        raise NotImplementedError
+
+    def release(self, armessage, sender, token):
+        """Cancel a reservation (the reply could not be sent)."""
+        raise NotImplementedError
+
+    def prefetch(self, pairs, timeout):
+        """Find pairs which will be throttled, without reserving anything.
+
+        Used to avoid claim() calls which would fail when many
+        messages are processed at once.
+
+        :param list pairs: list of (armessage id, sender) tuples
+        :return: the set of pairs known to be throttled
+        """
+        return set()
+
+
+class DatabaseThrottleBackend(BaseThrottleBackend):
+    """Store history in the ARhistoric table."""
+
+    def claim(self, armessage, sender, timeout):
+        return ARhistoric.objects.claim(armessage, sender, timeout)
+
+    def release(self, armessage, sender, token):
+        ARhistoric.objects.release(armessage, sender, token)
+
+    def prefetch(self, pairs, timeout):
+        return ARhistoric.objects.throttled(pairs, timeout)
+
+
+class MemoryThrottleBackend(BaseThrottleBackend):
+    """Bounded in-process store (LRU with expiration).
+
+    Only suitable for long-running processes (LMTP server) since
+    history is lost when the process exits.
+
+    Options: ``max_entries`` (default: 100000).
+    """
+
+    def __init__(self, **options):
+        super(MemoryThrottleBackend, self).__init__(**options)
+        self.max_entries = options.get("max_entries", 100000)
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def claim(self, armessage, sender, timeout):
+        key = (armessage.pk, sender)
+        now = time.monotonic()
+        with self.lock:
+            expiration = self.entries.get(key)
+            if expiration is not None and expiration > now:
+                return None
+            self.entries[key] = now + timeout
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return now + timeout
+
+    def release(self, armessage, sender, token):
+        key = (armessage.pk, sender)
+        with self.lock:
+            if self.entries.get(key) == token:
+                del self.entries[key]
+
+    def prefetch(self, pairs, timeout):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                pair for pair in pairs
+                if self.entries.get(pair, now) > now
+            }
+
+
+class CacheThrottleBackend(BaseThrottleBackend):
+    """Store history in a Django cache.
+
+    A cache shared by all processes of the node takes this traffic off
+    the main database. Its ``add()`` operation must be atomic
+    (memcached, redis, database): the file based cache checks then
+    writes the key, so concurrent claims could both succeed.
+
+    Options: ``cache`` (name of the cache to use, default: ``default``)
+    and ``key_prefix`` (default: ``autoreply``).
+    """
+
+    def __init__(self, **options):
+        super(CacheThrottleBackend, self).__init__(**options)
+        self.cache = caches[options.get("cache", "default")]
+        self.key_prefix = options.get("key_prefix", "autoreply")
+
+    def get_key(self, armessage, sender):
+        """Return a cache key valid for all backends."""
+        return self.get_pk_key(armessage.pk, sender)
+
+    def get_pk_key(self, armessage_id, sender):
+        digest = hashlib.sha256(sender.encode("utf-8")).hexdigest()
+        return "{}:{}:{}".format(self.key_prefix, armessage_id, digest)
+
+    def claim(self, armessage, sender, timeout):
+        token = time.time()
+        if self.cache.add(self.get_key(armessage, sender), token, timeout):
+            return token
+        return None
+
+    def release(self, armessage, sender, token):
+        key = self.get_key(armessage, sender)
+        if self.cache.get(key) == token:
+            self.cache.delete(key)
+
+    def prefetch(self, pairs, timeout):
+        keys = {self.get_pk_key(*pair): pair for pair in pairs}
+        return {keys[key] for key in self.cache.get_many(list(keys))}
+
+
+@functools.lru_cache(maxsize=None)
+def get_backend():
+    """Return the configured throttle backend."""
+    config = getattr(settings, "AUTOREPLY_THROTTLE", {})
+    backend_class = import_string(config.get("BACKEND", DEFAULT_BACKEND))
+    return backend_class(**config.get("OPTIONS", {}))